@@ -1,12 +1,17 @@
 from django.contrib import admin
 
-from .models import (MetadataFieldOverwrite, ReceiverEmailConfiguration,
-                     SenderEmailConfiguration, XIAConfiguration,
-                     XISConfiguration)
+from .models import (MetadataFieldOverwrite, MetadataValidationReport,
+                     ReceiverEmailConfiguration, SenderEmailConfiguration,
+                     SourceFile, XIAConfiguration, XISConfiguration)
 
 # Register your models here.
 
 
+class SourceFileInline(admin.TabularInline):
+    model = SourceFile
+    extra = 1
+
+
 @admin.register(XIAConfiguration)
 class XIAConfigurationAdmin(admin.ModelAdmin):
     list_display = (
@@ -14,12 +19,15 @@ class XIAConfigurationAdmin(admin.ModelAdmin):
         'source_metadata_schema',
         'source_target_mapping',
         'target_metadata_schema',
-        'source_file',)
+        'source_file',
+        'source_file_format',)
     fields = ['publisher',
               'source_metadata_schema',
               ('source_target_mapping',
                'target_metadata_schema',
-               'source_file')]
+               'source_file',
+               'source_file_format')]
+    inlines = [SourceFileInline]
 
 
 @admin.register(XISConfiguration)
@@ -50,3 +58,13 @@ class MetadataFieldOverwriteAdmin(admin.ModelAdmin):
               'field_type',
               'field_value',
               'overwrite']
+
+
+@admin.register(MetadataValidationReport)
+class MetadataValidationReportAdmin(admin.ModelAdmin):
+    list_display = ('validation_stage',
+                    'created',
+                    'record_count',
+                    'invalid_record_count',
+                    'incomplete_record_count',)
+    list_filter = ('validation_stage',)
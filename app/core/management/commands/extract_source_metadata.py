@@ -1,50 +1,243 @@
-import hashlib
-import json
 import logging
+from collections import Counter
 
 import pandas as pd
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
 
-from core.management.utils.xia_internal import (convert_date_to_isoformat,
+from core.management.utils.xia_internal import (SOURCE_METADATA_KEY_FIELDS,
+                                                compile_schema,
+                                                convert_date_to_isoformat,
+                                                dict_flatten,
+                                                get_metadata_hash,
                                                 get_publisher_detail,
                                                 get_source_metadata_key_value,
+                                                iterate_in_process_pool,
                                                 type_cast_overwritten_values)
-from core.management.utils.xsr_client import read_source_file
-from core.models import MetadataFieldOverwrite, MetadataLedger
+from core.management.utils.xsr_client import (get_source_file_digest,
+                                              get_source_file_fingerprint,
+                                              get_source_file_format,
+                                              get_source_files,
+                                              read_source_file_in_chunks)
+from core.management.utils.xss_client import (
+    get_source_validation_schema, get_target_metadata_for_transformation)
+from core.models import (MetadataFieldOverwrite, MetadataLedger,
+                         SourceFileFingerprint)
 
 logger = logging.getLogger('dict_config_logger')
 
+# number of ledger records looked up and written per query
+LEDGER_BATCH_SIZE = 500
 
-def get_source_metadata():
+# rows kept when several rows of the source have the same key
+DUPLICATE_POLICIES = ('first', 'last')
+
+# number of duplicate keys reported in the logs per chunk
+DUPLICATE_SAMPLE_SIZE = 10
+
+# inferred types of object columns which may hold date values
+DATE_INFERRED_TYPES = {'datetime', 'date', 'time', 'mixed', 'mixed-integer'}
+
+
+def get_source_metadata(force=False, project_columns=False, workers=1,
+                        duplicate_policy='last'):
     """Retrieving source metadata"""
 
-    #  Retrieve metadata from agents as a list of sources
-    df_source_list = read_source_file()
+    extraction_counts = Counter(new=0, changed=0, unchanged=0, removed=0,
+                                duplicate=0)
+    source_columns = None
+    if project_columns:
+        source_columns = get_source_columns_to_extract()
+    source_files = get_source_files()
+    # a source file removed from the configuration changes the settings
+    # hash, so its records are inactivated on the next extraction
+    extraction_settings_hash = get_extraction_settings_hash(
+        source_columns, duplicate_policy,
+        [source_file.name for source_file in source_files])
+    fingerprints = []
+    for source_file in source_files:
+        fingerprint = get_source_file_fingerprint(source_file)
+        fingerprint['extraction_settings_hash'] = extraction_settings_hash
+        fingerprints.append(fingerprint)
+    # Skipping parsing entirely when all source files were already
+    # extracted, as removed records can only be found across all files
+    if not force and all(
+            is_source_file_unchanged(source_file, fingerprint)
+            for source_file, fingerprint in zip(source_files, fingerprints)):
+        for source_file, fingerprint in zip(source_files, fingerprints):
+            store_source_file_fingerprint(source_file, fingerprint)
+        logger.info('Source files are unchanged since the last extraction, '
+                    'skipping extraction')
+        return extraction_counts
+
+    logger.info('Loading metadata to be extracted from source')
+    # Loading hashes of active records once so unchanged rows skip the
+    # database entirely
+    active_key_index = get_active_source_key_index()
+    # Compiling field overwrite rules once for all chunks
+    overwrite_plan = get_metadata_fields_to_overwrite()
+
+    arguments_list = [(source_file, get_source_file_format(source_file),
+                       source_columns)
+                      for source_file in source_files]
+    # Parsing source files concurrently, each worker returning the chunks
+    # of its file which are stored as soon as the file is read, or
+    # streaming one file at a time in this process
+    if workers > 1 and len(source_files) > 1:
+        file_chunks = iterate_in_process_pool(extract_source_file,
+                                              arguments_list, workers)
+    else:
+        file_chunks = (read_normalized_source_chunks(*arguments)
+                       for arguments in arguments_list)
+
+    # Key hashes of the records found in all source files
+    seen_key_hashes = set()
+    # Key values of the rows found in earlier chunks of all source files
+    seen_key_values = set()
+    empty_source = not source_files
+    # Storing chunks of all files in this process, so a key found in
+    # several files is deduplicated and written once
+    for source_chunks in file_chunks:
+        file_key_hashes = set()
+        for source_chunk in source_chunks:
+            extraction_counts.update(extract_metadata_using_key(
+                source_chunk, active_key_index, overwrite_plan,
+                file_key_hashes, duplicate_policy, seen_key_values))
+        empty_source = empty_source or not file_key_hashes
+        seen_key_hashes.update(file_key_hashes)
+
+    # an empty source is more likely a broken export than removed records
+    if not empty_source:
+        # Inactivating records which were active before this run but are
+        # no longer in any source file
+        extraction_counts['removed'] += inactivate_removed_source_records(
+            set(active_key_index) - seen_key_hashes)
+
+    for source_file, fingerprint in zip(source_files, fingerprints):
+        store_source_file_fingerprint(source_file, fingerprint)
+    return extraction_counts
+
+
+def read_normalized_source_chunks(source_file, source_file_format,
+                                  source_columns=None):
+    """Streaming chunks of one source file with JSON compatible values"""
+    logger.info('Extracting metadata from source file ' + source_file.name)
+    chunk_count = 0
+
+    #  Retrieve metadata from agents one chunk of rows at a time so memory
+    #  use does not depend on the size of the source file
+    for source_chunk in read_source_file_in_chunks(
+            source_file, source_file_format, columns=source_columns):
+        chunk_count += 1
+        yield normalize_source_metadata(source_chunk)
+
+    if not chunk_count:
+        logger.error("Source metadata is empty in " + source_file.name + "!")
 
-    # Iterate through the list of sources and extract metadata
-    for source_item in df_source_list:
-        logger.info('Loading metadata to be extracted from source')
 
-        # Changing null values to None for source dataframe
-        std_source_df = source_item.where(pd.notnull(source_item),
-                                          None)
-        if std_source_df.empty:
-            logger.error("Source metadata is empty!")
-        extract_metadata_using_key(std_source_df)
+def extract_source_file(source_file, source_file_format,
+                        source_columns=None):
+    """Reading all chunks of one source file in a worker process, returning
+    them to be stored by the parent process"""
+    return list(read_normalized_source_chunks(source_file, source_file_format,
+                                              source_columns))
 
 
-def get_metadata_fields_to_overwrite(metadata_df):
-    """looping through fields to be overwrite or appended"""
+def get_source_columns_to_extract():
+    """Retrieving names of source columns used for key creation,
+    validation and transformation"""
+    logger.info('Retrieving source columns to be extracted from schemas')
+    source_columns = set(SOURCE_METADATA_KEY_FIELDS)
+    # columns validated against the source validation schema
+    source_columns.update(compile_schema(
+        get_source_validation_schema()).fields)
+    # columns mapped to target fields by the transformation schema
+    for source_path in dict_flatten(get_target_metadata_for_transformation(),
+                                    []).values():
+        if source_path:
+            source_columns.update((source_path, source_path.split('.')[0]))
+    # columns appended or overwritten by the system operator
+    source_columns.update(MetadataFieldOverwrite.objects.values_list(
+        'field_name', flat=True))
+    return source_columns
+
+
+def get_extraction_settings_hash(source_columns=None,
+                                 duplicate_policy='last',
+                                 source_file_names=None):
+    """Creating hash of the settings applied to source metadata during
+    extraction"""
+    extraction_settings = {
+        'publisher': get_publisher_detail(),
+        'overwrite': list(MetadataFieldOverwrite.objects.order_by(
+            'id').values_list('field_name', 'field_type', 'field_value',
+                              'overwrite')),
+        'columns': sorted(source_columns) if source_columns else None,
+        'duplicate_policy': duplicate_policy,
+        'source_files': sorted(source_file_names or [])}
+    return get_metadata_hash(extraction_settings)
+
+
+def is_source_file_unchanged(source_file, fingerprint):
+    """Checking source file fingerprint against the fingerprint stored on
+    the last extraction"""
+    stored_fingerprint = SourceFileFingerprint.objects.filter(
+        source_file_name=fingerprint['source_file_name']).first()
+    if not stored_fingerprint or \
+            stored_fingerprint.source_file_size != \
+            fingerprint['source_file_size'] or \
+            stored_fingerprint.extraction_settings_hash != \
+            fingerprint['extraction_settings_hash']:
+        return False
+
+    # Same modified time or ETag means the content was not replaced
+    if (fingerprint['source_file_modified'] or
+            fingerprint['source_file_etag']) and \
+            stored_fingerprint.source_file_modified == \
+            fingerprint['source_file_modified'] and \
+            stored_fingerprint.source_file_etag == \
+            fingerprint['source_file_etag']:
+        fingerprint['source_file_digest'] = \
+            stored_fingerprint.source_file_digest
+        return True
+
+    # Comparing content when the file was touched or uploaded again
+    fingerprint['source_file_digest'] = get_source_file_digest(source_file)
+    return stored_fingerprint.source_file_digest == \
+        fingerprint['source_file_digest']
+
+
+def store_source_file_fingerprint(source_file, fingerprint):
+    """Storing fingerprint of the extracted source file"""
+    if 'source_file_digest' not in fingerprint:
+        fingerprint['source_file_digest'] = \
+            get_source_file_digest(source_file)
+    SourceFileFingerprint.objects.update_or_create(
+        source_file_name=fingerprint['source_file_name'],
+        defaults={field: value for field, value in fingerprint.items()
+                  if field != 'source_file_name'})
+
+
+def get_active_source_key_index():
+    """Retrieving metadata hash of active records in MetadataLedger keyed by
+    their key hash"""
+    logger.info('Loading index of active records in MetadataLedger')
+    active_key_index = dict(MetadataLedger.objects.filter(
+        record_lifecycle_status='Active').values_list(
+        'source_metadata_key_hash', 'source_metadata_hash'))
+    return active_key_index
+
+
+def get_metadata_fields_to_overwrite():
+    """Compiling fields to be overwrite or appended into an overwrite plan
+    of columns, typed values and overwrite flags"""
+    overwrite_plan = []
     for each in MetadataFieldOverwrite.objects.all():
-        column = each.field_name
-        overwrite_flag = each.overwrite
         # checking and converting type of overwritten values
         value = type_cast_overwritten_values(each.field_type, each.field_value)
-
-        metadata_df = overwrite_append_metadata(metadata_df, column, value,
-                                                overwrite_flag)
-    return metadata_df
+        overwrite_plan.append((each.field_name, value, each.overwrite))
+    return overwrite_plan
 
 
 def add_publisher_to_source(source_df):
@@ -60,91 +253,281 @@ def add_publisher_to_source(source_df):
 
 
 def overwrite_append_metadata(metadata_df, column, value, overwrite_flag):
-    """Overwrite & append metadata fields based on overwrite flag """
+    """Overwrite & append metadata fields based on overwrite flag and return
+    the new values of the field"""
 
     # field should be overwritten and append
-    if overwrite_flag:
-        metadata_df[column] = value
-    # skip field to be overwritten and append
-    else:
-        if column not in metadata_df.columns:
-            metadata_df[column] = value
-        else:
-            metadata_df.loc[metadata_df[column].isnull(), column] = value
-    return metadata_df
+    if overwrite_flag or column not in metadata_df.columns:
+        return value
+    # skip field to be overwritten and only fill in missing values
+    existing_values = metadata_df[column]
+    return existing_values.where(existing_values.notnull(), value)
 
 
-def overwrite_metadata_field(metadata_df):
-    """Overwrite & append metadata fields with admin entered values """
+def overwrite_metadata_field(metadata_df, overwrite_plan=None):
+    """Overwrite & append metadata fields of a normalized chunk with admin
+    entered values"""
     logger.info("Overwrite & append metadata fields with admin entered values")
-    # get metadata fields to be overwritten and appended and replace values
-    metadata_df = get_metadata_fields_to_overwrite(metadata_df)
-    # return source metadata as dictionary
+    if overwrite_plan is None:
+        overwrite_plan = get_metadata_fields_to_overwrite()
+    # replace each field once with the values of its overwrite rule
+    for column, value, overwrite_flag in overwrite_plan:
+        metadata_df[column] = overwrite_append_metadata(
+            metadata_df, column, value, overwrite_flag)
+    # source chunks are already normalized, so only overwritten columns are
+    # converted again
+    overwritten_columns = list(dict.fromkeys(
+        column for column, _, _ in overwrite_plan))
+    if overwritten_columns:
+        metadata_df[overwritten_columns] = normalize_source_metadata(
+            metadata_df[overwritten_columns])
+    # return source metadata as dictionary of JSON compatible rows
     source_data_dict = metadata_df.to_dict(orient='index')
     return source_data_dict
 
 
-def store_source_metadata(key_value, key_value_hash, hash_value, metadata):
+def convert_datetime_column_to_isoformat(column):
+    """Converting datetime column of source metadata to ISO format"""
+    # timezone aware values keep their UTC offset in ISO format
+    if column.dt.tz is not None:
+        return column.map(convert_date_to_isoformat, na_action='ignore')
+    isoformat_column = column.dt.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    # datetime.isoformat leaves out microseconds when they are zero
+    return isoformat_column.str.replace(r'\.0{6}$', '', regex=True)
+
+
+def normalize_source_metadata(metadata_df):
+    """Converting dates and null values of source metadata to JSON
+    compatible values for all rows at once"""
+    metadata_df = metadata_df.copy()
+    for column in metadata_df.columns:
+        if pd.api.types.is_datetime64_any_dtype(metadata_df[column]):
+            metadata_df[column] = \
+                convert_datetime_column_to_isoformat(metadata_df[column])
+        # only object columns holding date values are converted one by one
+        elif metadata_df[column].dtype == object and \
+                pd.api.types.infer_dtype(metadata_df[column], skipna=True) \
+                in DATE_INFERRED_TYPES:
+            metadata_df[column] = metadata_df[column].map(
+                convert_date_to_isoformat, na_action='ignore')
+    # Changing NaN and NaT values to None
+    metadata_df = metadata_df.astype(object)
+    return metadata_df.where(metadata_df.notnull(), None)
+
+
+def drop_duplicate_source_rows(source_df, duplicate_policy='last',
+                               seen_key_values=None):
+    """Dropping source rows with the same key as another row, keeping one
+    row per key under the duplicate policy, and returning the kept rows
+    with the key values of the duplicates"""
+    if not set(SOURCE_METADATA_KEY_FIELDS) <= set(source_df.columns):
+        return source_df, []
+    key_df = source_df[SOURCE_METADATA_KEY_FIELDS].fillna('').astype(str)
+    # rows missing a key field are never stored, so they are not duplicates
+    keyed_rows = key_df.ne('').all(axis=1)
+    # key values are joined the same way get_source_metadata_key_value does
+    key_values = key_df.iloc[:, 0].str.cat(
+        [key_df[field] for field in SOURCE_METADATA_KEY_FIELDS[1:]],
+        sep='_')
+
+    duplicate_rows = keyed_rows & key_values.duplicated(keep=duplicate_policy)
+    reported_rows = duplicate_rows
+    if seen_key_values is not None:
+        earlier_rows = keyed_rows & key_values.isin(seen_key_values)
+        # rows of earlier chunks are already stored, so only the first
+        # policy can still keep them
+        if duplicate_policy == 'first':
+            duplicate_rows = duplicate_rows | earlier_rows
+        reported_rows = duplicate_rows | earlier_rows
+        seen_key_values.update(key_values[keyed_rows])
+    return source_df[~duplicate_rows], key_values[reported_rows].tolist()
+
+
+def get_source_metadata_record(key_value, key_value_hash, hash_value,
+                               metadata):
+    """Creating source metadata record to be stored in metadata ledger"""
+    record = {'key_value': key_value, 'key_value_hash': key_value_hash,
+              'hash_value': hash_value, 'metadata': metadata}
+    return record
+
+
+def store_source_metadata(source_records, batch_size=LEDGER_BATCH_SIZE):
     """Extract data from Experience Source Repository(XSR)
-        and store in metadata ledger
+        and store in metadata ledger in batches
     """
-    # Setting record_status & deleted_date for updated record
-    MetadataLedger.objects.filter(
-        source_metadata_key_hash=key_value_hash,
-        record_lifecycle_status='Active').exclude(
-        source_metadata_hash=hash_value).update(
-        metadata_record_inactivation_date=timezone.now())
-    MetadataLedger.objects.filter(
-        source_metadata_key_hash=key_value_hash,
-        record_lifecycle_status='Active').exclude(
-        source_metadata_hash=hash_value).update(
-        record_lifecycle_status='Inactive')
-
-    # Retrieving existing records or creating new record to MetadataLedger
-    MetadataLedger.objects.get_or_create(
-        source_metadata_key=key_value,
-        source_metadata_key_hash=key_value_hash,
-        source_metadata=metadata,
-        source_metadata_hash=hash_value,
-        record_lifecycle_status='Active')
-
-
-def extract_metadata_using_key(source_df):
+    store_counts = Counter(new=0, changed=0, unchanged=0)
+    # Later rows win when a key appears more than once in the source
+    records_by_key = {record['key_value_hash']: record
+                      for record in source_records}
+    key_hashes = list(records_by_key)
+
+    for start in range(0, len(key_hashes), batch_size):
+        batch_key_hashes = key_hashes[start:start + batch_size]
+
+        # Retrieving existing active records of the batch in one query
+        active_records = {}
+        for record_uuid, key_value_hash, hash_value in \
+                MetadataLedger.objects.filter(
+                    source_metadata_key_hash__in=batch_key_hashes,
+                    record_lifecycle_status='Active').values_list(
+                    'metadata_record_uuid', 'source_metadata_key_hash',
+                    'source_metadata_hash'):
+            active_records.setdefault(key_value_hash, {})[hash_value] = \
+                record_uuid
+
+        # Working out new, changed and unchanged records in memory
+        records_to_inactivate = []
+        records_to_create = []
+        for key_value_hash in batch_key_hashes:
+            record = records_by_key[key_value_hash]
+            existing_records = active_records.get(key_value_hash, {})
+            if not existing_records:
+                store_counts['new'] += 1
+            elif set(existing_records) == {record['hash_value']}:
+                store_counts['unchanged'] += 1
+                continue
+            else:
+                store_counts['changed'] += 1
+                records_to_inactivate.extend(
+                    record_uuid for hash_value, record_uuid in
+                    existing_records.items()
+                    if hash_value != record['hash_value'])
+                if record['hash_value'] in existing_records:
+                    continue
+            records_to_create.append(MetadataLedger(
+                source_metadata_key=record['key_value'],
+                source_metadata_key_hash=key_value_hash,
+                source_metadata=record['metadata'],
+                source_metadata_hash=record['hash_value'],
+                record_lifecycle_status='Active'))
+
+        with transaction.atomic():
+            # Setting record_status & deleted_date for updated records
+            if records_to_inactivate:
+                MetadataLedger.objects.filter(
+                    metadata_record_uuid__in=records_to_inactivate).update(
+                    record_lifecycle_status='Inactive',
+                    metadata_record_inactivation_date=timezone.now())
+            # Creating new records in MetadataLedger
+            MetadataLedger.objects.bulk_create(records_to_create)
+
+    return store_counts
+
+
+def inactivate_removed_source_records(key_hashes,
+                                      batch_size=LEDGER_BATCH_SIZE):
+    """Setting record_status & deleted_date for active records removed
+    from the source in batches"""
+    key_hashes = list(key_hashes)
+    inactivated_count = 0
+    inactivation_date = timezone.now()
+    for start in range(0, len(key_hashes), batch_size):
+        inactivated_count += MetadataLedger.objects.filter(
+            source_metadata_key_hash__in=key_hashes[start:start + batch_size],
+            record_lifecycle_status='Active').update(
+            record_lifecycle_status='Inactive',
+            metadata_record_inactivation_date=inactivation_date)
+    if inactivated_count:
+        logger.info('Inactivated ' + str(inactivated_count) +
+                    ' records removed from the source')
+    return inactivated_count
+
+
+def extract_metadata_using_key(source_df, active_key_index=None,
+                               overwrite_plan=None, seen_key_hashes=None,
+                               duplicate_policy='last', seen_key_values=None):
     """Creating key, hash of key & hash of metadata """
     # Convert source data to dictionary and add publisher to metadata
     source_df = add_publisher_to_source(source_df)
+    # Keeping one row per key so each key is written once
+    source_df, duplicate_key_values = drop_duplicate_source_rows(
+        source_df, duplicate_policy, seen_key_values)
+    if duplicate_key_values:
+        logger.warning('Found ' + str(len(duplicate_key_values)) +
+                       ' source rows with duplicate keys, keeping the ' +
+                       duplicate_policy + ' row of ' +
+                       ', '.join(duplicate_key_values[
+                                 :DUPLICATE_SAMPLE_SIZE]))
     # Overwrite & append metadata fields with admin entered values
-    source_data_dict = overwrite_metadata_field(source_df)
+    source_data_dict = overwrite_metadata_field(source_df, overwrite_plan)
+
+    source_records = []
+    # rows are already JSON compatible, so they are hashed and stored as is
+    for temp_val in source_data_dict.values():
+        # key dictionary creation function called
+        key = get_source_metadata_key_value(temp_val)
+        if key:
+            # creating hash value of metadata
+            hash_value = get_metadata_hash(temp_val)
+            source_records.append(get_source_metadata_record(
+                key['key_value'], key['key_value_hash'], hash_value,
+                temp_val))
+
+    if seen_key_hashes is not None:
+        seen_key_hashes.update(record['key_value_hash']
+                               for record in source_records)
+
+    extraction_counts = Counter(duplicate=len(duplicate_key_values))
+    if active_key_index is not None:
+        # Skipping records already active with the same metadata hash
+        changed_records = [
+            record for record in source_records
+            if active_key_index.get(record['key_value_hash']) !=
+            record['hash_value']]
+        extraction_counts['unchanged'] += \
+            len(source_records) - len(changed_records)
+        source_records = changed_records
 
     logger.info('Setting record_status & deleted_date for updated record')
     logger.info('Getting existing records or creating new record to '
                 'MetadataLedger')
-    for temp_key, temp_val in source_data_dict.items():
-        # creating hash value of metadata
-        hash_value = hashlib.md5(str(temp_val).encode('utf-8')).hexdigest()
-        # key dictionary creation function called
-        key = \
-            get_source_metadata_key_value(source_data_dict[temp_key])
+    # Call store function with key, hash of key, hash of metadata,
+    # metadata for the whole chunk
+    extraction_counts.update(store_source_metadata(source_records))
 
-        # Call store function with key, hash of key, hash of metadata,
-        # metadata
-
-        temp_val_convert = json.dumps(temp_val,
-                                      default=convert_date_to_isoformat)
-        temp_val_json = json.loads(temp_val_convert)
-        if key:
-            store_source_metadata(key['key_value'], key['key_value_hash'],
-                                  hash_value, temp_val_json)
+    if active_key_index is not None:
+        active_key_index.update(
+            (record['key_value_hash'], record['hash_value'])
+            for record in source_records)
+    return extraction_counts
 
 
 class Command(BaseCommand):
     """Django command to extract data from Experience Source Repository (
     XSR) """
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Extract the source file even if it is unchanged since '
+                 'the last extraction')
+        parser.add_argument(
+            '--project-columns', action='store_true',
+            help='Only extract source columns used by the validation and '
+                 'transformation schemas, skipping supplemental columns')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes reading source files in parallel. '
+                 'Each file read by a worker is held in memory whole until '
+                 'its records are stored')
+        parser.add_argument(
+            '--duplicate-policy', choices=DUPLICATE_POLICIES, default='last',
+            help='Row kept when several source rows have the same key')
+
     def handle(self, *args, **options):
         """
             Metadata is extracted from XSR and stored in Metadata Ledger
         """
-        get_source_metadata()
+        extraction_counts = get_source_metadata(
+            force=options.get('force', False),
+            project_columns=options.get('project_columns', False),
+            workers=options.get('workers', 1),
+            duplicate_policy=options.get('duplicate_policy', 'last'))
 
         logger.info('MetadataLedger updated with extracted data from XSR')
+        logger.info('Extracted records: ' +
+                    str(extraction_counts['new']) + ' new, ' +
+                    str(extraction_counts['changed']) + ' changed, ' +
+                    str(extraction_counts['unchanged']) + ' unchanged, ' +
+                    str(extraction_counts['removed']) + ' removed, ' +
+                    str(extraction_counts['duplicate']) + ' duplicate')
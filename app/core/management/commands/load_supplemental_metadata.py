@@ -7,7 +7,8 @@ from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q
 from django.utils import timezone
 
-from core.management.utils.xia_internal import get_publisher_detail
+from core.management.utils.xia_internal import (get_publisher_detail,
+                                                iterate_ledger)
 from core.management.utils.xis_client import \
     posting_supplemental_metadata_to_xis
 from core.models import SupplementalLedger
@@ -31,7 +32,7 @@ def post_supplemental_metadata_to_xis(data):
     """POSTing XIA metadata_ledger to XIS metadata_ledger"""
     # Traversing through each row one by one from data
     # get_xis_supplemental_metadata_api_endpoint
-    for row in data:
+    for row in iterate_ledger(data):
         data = rename_supplemental_metadata_fields(row)
         renamed_data = json.dumps(data, cls=DjangoJSONEncoder)
 
@@ -95,7 +96,7 @@ def load_supplemental_metadata_to_xis():
         'supplemental_metadata_key_hash')
 
     # Checking available no. of records in XIA to load into XIS is Zero or not
-    if len(data) == 0:
+    if not data.exists():
         logger.info("Supplemental Metadata Loading in XIS is complete, "
                     "Zero records are available in XIA to transmit")
     else:
@@ -7,7 +7,8 @@ from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q
 from django.utils import timezone
 
-from core.management.utils.xia_internal import get_publisher_detail
+from core.management.utils.xia_internal import (get_publisher_detail,
+                                                iterate_ledger)
 from core.management.utils.xis_client import posting_metadata_ledger_to_xis
 from core.models import MetadataLedger
 
@@ -29,7 +30,7 @@ def rename_metadata_ledger_fields(data):
 def post_data_to_xis(data):
     """POSTing XIA metadata_ledger to XIS metadata_ledger"""
     # Traversing through each row one by one from data
-    for row in data:
+    for row in iterate_ledger(data):
         data = rename_metadata_ledger_fields(row)
         renamed_data = json.dumps(data, cls=DjangoJSONEncoder)
 
@@ -93,7 +94,7 @@ def get_records_to_load_into_xis():
         'target_metadata_key_hash')
 
     # Checking available no. of records in XIA to load into XIS is Zero or not
-    if len(data) == 0:
+    if not data.exists():
         logger.info("Data Loading in XIS is complete, Zero records are "
                     "available in XIA to transmit")
     else:
@@ -0,0 +1,144 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.management.utils.xia_internal import (get_metadata_hash,
+                                                iterate_ledger)
+from core.models import MetadataLedger, SupplementalLedger
+
+logger = logging.getLogger('dict_config_logger')
+
+# number of ledger records read and written per query
+REHASH_BATCH_SIZE = 500
+
+
+def store_rehashed_records(records_to_update):
+    """Storing recalculated hashes in MetadataLedger"""
+    MetadataLedger.objects.bulk_update(
+        records_to_update, ['source_metadata_hash', 'target_metadata_hash'])
+
+
+def is_transformed_later(record, other_record):
+    """Checking if a supplemental record was transformed after another"""
+    transformation_date = record.supplemental_metadata_transformation_date
+    other_date = other_record.supplemental_metadata_transformation_date
+    return other_date is None or (transformation_date is not None and
+                                  transformation_date > other_date)
+
+
+def store_rehashed_supplemental_records(records_to_rehash):
+    """Storing recalculated hashes of a batch of records in
+    SupplementalLedger, keeping the latest transformed record of a key and
+    hash"""
+    if not records_to_rehash:
+        return
+    # Retrieving other records stored for the keys of the batch
+    stored_records = {
+        (record.supplemental_metadata_key_hash,
+         record.supplemental_metadata_hash): record
+        for record in SupplementalLedger.objects.filter(
+            supplemental_metadata_key_hash__in={
+                record.supplemental_metadata_key_hash
+                for record in records_to_rehash}).exclude(
+            metadata_record_uuid__in=[record.metadata_record_uuid
+                                      for record in records_to_rehash]).only(
+            'metadata_record_uuid', 'supplemental_metadata_key_hash',
+            'supplemental_metadata_hash',
+            'supplemental_metadata_transformation_date')}
+
+    records_to_update = {}
+    records_to_delete = []
+    for record in records_to_rehash:
+        key = (record.supplemental_metadata_key_hash,
+               record.supplemental_metadata_hash)
+        stored_record = stored_records.get(key)
+        # only one supplemental record is kept for a key and hash
+        if stored_record:
+            if not is_transformed_later(record, stored_record):
+                records_to_delete.append(record.metadata_record_uuid)
+                continue
+            records_to_delete.append(stored_record.metadata_record_uuid)
+            records_to_update.pop(stored_record.metadata_record_uuid, None)
+        stored_records[key] = record
+        records_to_update[record.metadata_record_uuid] = record
+
+    SupplementalLedger.objects.filter(
+        metadata_record_uuid__in=records_to_delete).delete()
+    SupplementalLedger.objects.bulk_update(records_to_update.values(),
+                                           ['supplemental_metadata_hash'])
+
+
+def rehash_supplemental_ledger(batch_size=REHASH_BATCH_SIZE):
+    """Recalculating hashes of the supplemental metadata of every record in
+    SupplementalLedger"""
+    rehashed_count = 0
+    records_to_rehash = []
+    # Streaming records from SupplementalLedger one page at a time
+    for record in iterate_ledger(SupplementalLedger.objects.only(
+            'metadata_record_uuid', 'supplemental_metadata',
+            'supplemental_metadata_hash', 'supplemental_metadata_key_hash',
+            'supplemental_metadata_transformation_date'), batch_size):
+        hash_value = get_metadata_hash(record.supplemental_metadata)
+        if hash_value == record.supplemental_metadata_hash:
+            continue
+        record.supplemental_metadata_hash = hash_value
+        records_to_rehash.append(record)
+        if len(records_to_rehash) == batch_size:
+            store_rehashed_supplemental_records(records_to_rehash)
+            rehashed_count += len(records_to_rehash)
+            records_to_rehash = []
+
+    store_rehashed_supplemental_records(records_to_rehash)
+    rehashed_count += len(records_to_rehash)
+    return rehashed_count
+
+
+def rehash_metadata_ledger(batch_size=REHASH_BATCH_SIZE):
+    """Recalculating source and target metadata hashes of every record in
+    MetadataLedger and supplemental metadata hashes in SupplementalLedger"""
+    logger.info('Recalculating metadata hashes of records in MetadataLedger')
+    rehashed_count = 0
+    records_to_update = []
+
+    with transaction.atomic():
+        # Streaming records from MetadataLedger one page at a time
+        for record in iterate_ledger(MetadataLedger.objects.only(
+                'metadata_record_uuid', 'source_metadata',
+                'source_metadata_hash', 'target_metadata',
+                'target_metadata_hash'), batch_size):
+            source_hash = get_metadata_hash(record.source_metadata)
+            target_hash = record.target_metadata_hash
+            if record.target_metadata_hash and record.target_metadata:
+                target_hash = get_metadata_hash(record.target_metadata)
+
+            if (source_hash, target_hash) == (record.source_metadata_hash,
+                                              record.target_metadata_hash):
+                continue
+            record.source_metadata_hash = source_hash
+            record.target_metadata_hash = target_hash
+            records_to_update.append(record)
+            if len(records_to_update) == batch_size:
+                store_rehashed_records(records_to_update)
+                rehashed_count += len(records_to_update)
+                records_to_update = []
+
+        store_rehashed_records(records_to_update)
+        rehashed_count += len(records_to_update)
+        supplemental_count = rehash_supplemental_ledger(batch_size)
+
+    logger.info('Recalculated metadata hashes of ' + str(rehashed_count) +
+                ' records in MetadataLedger and ' + str(supplemental_count) +
+                ' records in SupplementalLedger')
+    return rehashed_count
+
+
+class Command(BaseCommand):
+    """Django command to recalculate the metadata hashes stored in the
+    ledgers after the hashing scheme changed"""
+
+    def handle(self, *args, **options):
+        """
+            Metadata hashes are recalculated and stored in Metadata Ledger
+        """
+        rehash_metadata_ledger()
@@ -1,28 +1,38 @@
-import hashlib
 import logging
+from collections import Counter
 
-import pandas as pd
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
 
-from core.management.utils.xia_internal import (dict_flatten,
+from core.management.utils.xia_internal import (compile_mapping,
+                                                compile_schema, dict_flatten,
+                                                get_metadata_hash,
                                                 get_target_metadata_key_value,
+                                                iterate_ledger,
                                                 replace_field_on_target_schema)
 from core.management.utils.xss_client import (
-    get_required_fields_for_validation, get_source_validation_schema,
-    get_target_metadata_for_transformation)
+    get_source_validation_schema, get_target_metadata_for_transformation)
 from core.models import MetadataLedger, SupplementalLedger
 
 logger = logging.getLogger('dict_config_logger')
 
+# number of transformed records stored at once
+TRANSFORMATION_CHUNK_SIZE = 500
 
-def get_source_metadata_for_transformation():
+
+def get_source_metadata_for_transformation(mapping_version):
     """Retrieving Source metadata from MetadataLedger that needs to be
         transformed"""
     logger.info(
         "Retrieving source metadata from MetadataLedger to be transformed")
+    # records are transformed again only when their hash or the mapping
+    # changed
     source_data_dict = MetadataLedger.objects.values(
         'source_metadata').filter(
+        ~Q(source_metadata_transformation_hash=F('source_metadata_hash'),
+           target_mapping_version=mapping_version),
         source_metadata_validation_status='Y',
         record_lifecycle_status='Active').exclude(
         source_metadata_validation_date=None)
@@ -44,10 +54,8 @@ def create_target_metadata_dict(target_mapping_dict, source_metadata,
     """Function to replace and transform source data to target data for
     using target mapping schema"""
 
-    # Create dataframe using target metadata schema
-    target_schema = pd.DataFrame.from_dict(
-        target_mapping_dict,
-        orient='index')
+    # target mapping schema is compiled once for all records
+    target_mapping_dict = compile_mapping(target_mapping_dict)
 
     # Flatten source data dictionary for replacing and transformation
     source_metadata = dict_flatten(source_metadata, required_column_list)
@@ -56,110 +64,159 @@ def create_target_metadata_dict(target_mapping_dict, source_metadata,
     source_metadata = {
         k: '' if not v else v for k, v in
         source_metadata.items()}
-    # assigning flattened source data
-    metadata = dict_flatten(source_metadata, required_column_list)
 
     # send values to be skipped while creating supplemental data
     supplemental_metadata = \
-        create_supplemental_metadata(target_schema.values.tolist(), metadata)
-
-    # Replacing metadata schema with mapped values from source metadata
-    target_schema = target_schema.replace(source_metadata)
-
-    # Dropping index value and creating json object
-    target_data = target_schema.apply(lambda x: [x.dropna()],
-                                      axis=1).to_json()
+        create_supplemental_metadata([target_mapping_dict.source_paths],
+                                     dict(source_metadata))
 
-    # Creating dataframe from json object
-    target_data_df = pd.read_json(target_data)
-
-    # transforming target dataframe to dictionary object for replacing
-    # values in target with new value
-    target_data_dict = target_data_df.to_dict(orient='index')
+    # Replacing source paths of mapping schema with values from source
+    # metadata
+    target_data_dict = {0: target_mapping_dict.apply(source_metadata)}
 
     return target_data_dict, supplemental_metadata
 
 
-def store_transformed_source_metadata(key_value, key_value_hash,
-                                      target_data_dict,
-                                      hash_value, supplemental_metadata):
-    """Storing target metadata in MetadataLedger"""
-    data_for_transformation = MetadataLedger.objects.filter(
-        source_metadata_key=key_value,
+def get_transformed_record(key_value, key_value_hash, target_metadata,
+                           hash_value, supplemental_metadata):
+    """Creating transformed record to be stored in metadata ledger"""
+    record = {'key_value': key_value, 'key_value_hash': key_value_hash,
+              'target_metadata': target_metadata, 'hash_value': hash_value,
+              'supplemental_metadata': supplemental_metadata}
+    return record
+
+
+def store_transformed_source_metadata(transformed_records,
+                                      mapping_version=None):
+    """Storing target metadata of a batch of transformed records in
+    MetadataLedger and their supplemental metadata in SupplementalLedger,
+    returning counts of changed and unchanged target metadata"""
+    store_counts = Counter(changed=0, unchanged=0)
+    # Later records win when a key appears more than once in the batch
+    records_by_key = {record['key_value']: record
+                      for record in transformed_records}
+
+    # Retrieving ledger records of the batch with their dates in one query
+    ledger_records = MetadataLedger.objects.filter(
+        source_metadata_key__in=list(records_by_key),
         record_lifecycle_status='Active',
-        source_metadata_validation_status='Y'
-    )
-
-    if data_for_transformation.values("target_metadata_hash") != hash_value:
-        data_for_transformation.update(target_metadata_validation_status='')
-
-    data_for_transformation.update(
-        source_metadata_transformation_date=timezone.now(),
-        target_metadata_key=key_value,
-        target_metadata_key_hash=key_value_hash,
-        target_metadata=target_data_dict,
-        target_metadata_hash=hash_value)
-
-    # check if metadata has corresponding supplemental values and store
-    if supplemental_metadata:
-        source_extraction_date = MetadataLedger.objects.values_list(
-            "source_metadata_extraction_date", flat=True).get(
-            source_metadata_key=key_value,
-            record_lifecycle_status='Active',
-            source_metadata_validation_status='Y')
-
-        transformation_date = MetadataLedger.objects.values_list(
-            "source_metadata_transformation_date", flat=True).get(
-            source_metadata_key=key_value,
-            record_lifecycle_status='Active',
-            source_metadata_validation_status='Y')
-
-        SupplementalLedger.objects.get_or_create(
-            supplemental_metadata_hash=hash_value,
-            supplemental_metadata_key=key_value,
-            supplemental_metadata_key_hash=key_value_hash,
-            supplemental_metadata_transformation_date=transformation_date,
-            supplemental_metadata_extraction_date=source_extraction_date,
-            supplemental_metadata=supplemental_metadata,
-            record_lifecycle_status='Active')
+        source_metadata_validation_status='Y').only(
+        'metadata_record_uuid', 'source_metadata_key',
+        'source_metadata_hash', 'source_metadata_extraction_date',
+        'target_metadata_hash', 'target_metadata_validation_status',
+        'target_metadata_transmission_status',
+        'target_metadata_transmission_status_code')
+
+    transformation_date = timezone.now()
+    records_to_update = []
+    supplemental_records = []
+    for ledger_record in ledger_records:
+        record = records_by_key[ledger_record.source_metadata_key]
+        # changed target metadata is validated and transmitted again
+        if ledger_record.target_metadata_hash != record['hash_value']:
+            store_counts['changed'] += 1
+            ledger_record.target_metadata_validation_status = ''
+            ledger_record.target_metadata_transmission_status = 'Ready'
+            ledger_record.target_metadata_transmission_status_code = None
+        else:
+            store_counts['unchanged'] += 1
+        ledger_record.source_metadata_transformation_date = \
+            transformation_date
+        ledger_record.target_metadata_key = record['key_value']
+        ledger_record.target_metadata_key_hash = record['key_value_hash']
+        ledger_record.target_metadata = record['target_metadata']
+        ledger_record.target_metadata_hash = record['hash_value']
+        ledger_record.source_metadata_transformation_hash = \
+            ledger_record.source_metadata_hash
+        ledger_record.target_mapping_version = mapping_version or ''
+        records_to_update.append(ledger_record)
+
+        # check if metadata has corresponding supplemental values and store
+        # them again whenever their content changed
+        if record['supplemental_metadata']:
+            supplemental_records.append(SupplementalLedger(
+                supplemental_metadata_hash=get_metadata_hash(
+                    record['supplemental_metadata']),
+                supplemental_metadata_key=record['key_value'],
+                supplemental_metadata_key_hash=record['key_value_hash'],
+                supplemental_metadata_transformation_date=transformation_date,
+                supplemental_metadata_extraction_date=ledger_record
+                .source_metadata_extraction_date,
+                supplemental_metadata=record['supplemental_metadata'],
+                record_lifecycle_status='Active'))
+
+    with transaction.atomic():
+        MetadataLedger.objects.bulk_update(
+            records_to_update,
+            ['target_metadata_validation_status',
+             'target_metadata_transmission_status',
+             'target_metadata_transmission_status_code',
+             'source_metadata_transformation_date', 'target_metadata_key',
+             'target_metadata_key_hash', 'target_metadata',
+             'target_metadata_hash', 'source_metadata_transformation_hash',
+             'target_mapping_version'])
+        # supplemental records already stored for a key and supplemental
+        # metadata are kept
+        SupplementalLedger.objects.bulk_create(supplemental_records,
+                                               ignore_conflicts=True)
+    return store_counts
+
+
+def get_transformed_records(target_data_dict, supplemental_metadata):
+    """Creating transformed records of target metadata with its key and
+    hash"""
+    transformed_records = []
+    # Looping through target values in dictionary
+    for ind1 in target_data_dict:
+        # Replacing values in field referring target schema
+        replace_field_on_target_schema(ind1,
+                                       target_data_dict)
+        # Key creation for target metadata
+        key = get_target_metadata_key_value(target_data_dict[ind1])
+
+        hash_value = get_metadata_hash(target_data_dict[ind1])
+        transformed_records.append(
+            get_transformed_record(key['key_value'], key['key_value_hash'],
+                                   target_data_dict[ind1], hash_value,
+                                   supplemental_metadata))
+    return transformed_records
 
 
 def transform_source_using_key(source_data_dict, target_mapping_dict,
-                               required_column_list):
+                               required_column_list,
+                               chunk_size=TRANSFORMATION_CHUNK_SIZE):
     """Transforming source data using target metadata schema"""
     logger.info(
         "Transforming source data using target renaming and mapping "
         "schemas and storing in json format ")
     logger.info("Identifying supplemental data and storing them ")
-    len_source_metadata = len(source_data_dict)
-    for ind in range(len_source_metadata):
-        for table_column_name in source_data_dict[ind]:
-
+    compiled_mapping = compile_mapping(target_mapping_dict)
+    # transformed records waiting to be stored
+    transformed_records = []
+    store_counts = Counter(changed=0, unchanged=0)
+    # Streaming records from MetadataLedger one page at a time
+    for source_record in iterate_ledger(source_data_dict):
+        for table_column_name in source_record:
             target_data_dict, supplemental_metadata = \
-                create_target_metadata_dict(target_mapping_dict,
-                                            source_data_dict
-                                            [ind]
-                                            [table_column_name],
-                                            required_column_list
-                                            )
-            # Looping through target values in dictionary
-            for ind1 in target_data_dict:
-                # Replacing values in field referring target schema
-                replace_field_on_target_schema(ind1,
-                                               target_data_dict)
-                # Key creation for target metadata
-                key = get_target_metadata_key_value(target_data_dict[ind1])
-
-                hash_value = hashlib.md5(
-                    str(target_data_dict[ind1]).encode(
-                        'utf-8')).hexdigest()
-                store_transformed_source_metadata(key['key_value'],
-                                                  key[
-                                                      'key_value_hash'],
-                                                  target_data_dict[
-                                                      ind1],
-                                                  hash_value,
-                                                  supplemental_metadata)
+                create_target_metadata_dict(compiled_mapping,
+                                            source_record[table_column_name],
+                                            required_column_list)
+            transformed_records.extend(
+                get_transformed_records(target_data_dict,
+                                        supplemental_metadata))
+            if len(transformed_records) >= chunk_size:
+                store_counts.update(store_transformed_source_metadata(
+                    transformed_records, compiled_mapping.version))
+                transformed_records = []
+
+    if transformed_records:
+        store_counts.update(store_transformed_source_metadata(
+            transformed_records, compiled_mapping.version))
+
+    logger.info('Target metadata changed for ' +
+                str(store_counts['changed']) + ' records and is unchanged '
+                'for ' + str(store_counts['unchanged']) + ' records')
+    return store_counts
 
 
 class Command(BaseCommand):
@@ -169,12 +226,12 @@ class Command(BaseCommand):
         """
             Metadata is transformed in the XIA and stored in Metadata Ledger
         """
-        target_mapping_dict = get_target_metadata_for_transformation()
-        source_data_dict = get_source_metadata_for_transformation()
-        schema_data_dict = get_source_validation_schema()
-        required_column_list, recommended_column_list = \
-            get_required_fields_for_validation(schema_data_dict)
-        transform_source_using_key(source_data_dict, target_mapping_dict,
-                                   required_column_list)
+        compiled_mapping = compile_mapping(
+            get_target_metadata_for_transformation())
+        source_data_dict = get_source_metadata_for_transformation(
+            compiled_mapping.version)
+        compiled_schema = compile_schema(get_source_validation_schema())
+        transform_source_using_key(source_data_dict, compiled_mapping,
+                                   compiled_schema)
 
         logger.info('MetadataLedger updated with transformed data in XIA')
@@ -1,102 +1,217 @@
 import logging
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 
-from core.management.utils.xia_internal import (dict_flatten, get_key_dict,
+from core.management.utils.xia_internal import (VALIDATION_BATCH_SIZE,
+                                                VALIDATION_SAMPLE_SIZE,
+                                                ValidationReport,
+                                                compile_schema, dict_flatten,
+                                                get_key_dict,
+                                                get_ledger_pk_ranges,
                                                 get_source_metadata_key_value,
-                                                required_recommended_logs)
-from core.management.utils.xss_client import (
-    get_required_fields_for_validation, get_source_validation_schema)
+                                                get_validation_fingerprint,
+                                                iterate_ledger,
+                                                run_in_process_pool,
+                                                store_validation_results)
+from core.management.utils.xss_client import get_source_validation_schema
 from core.models import MetadataLedger
 
 logger = logging.getLogger('dict_config_logger')
 
+# number of records validated by a worker process at a time
+VALIDATION_CHUNK_SIZE = 5000
 
-def get_source_metadata_for_validation():
+
+def restore_source_metadata_validation_status(schema_version):
+    """Restoring validation status of records in MetadataLedger which were
+    already validated with the same record hash and schema version"""
+    # records failing validation are inactivated, so a matching fingerprint
+    # on an active record means it passed validation
+    restored_count = MetadataLedger.objects.filter(
+        source_metadata_validation_status='',
+        record_lifecycle_status='Active',
+        source_metadata_validation_fingerprint=get_validation_fingerprint(
+            'source_metadata_hash', schema_version)).update(
+        source_metadata_validation_status='Y',
+        source_metadata_validation_date=timezone.now())
+    logger.info("Skipped validation of " + str(restored_count) +
+                " unchanged source records")
+    return restored_count
+
+
+def get_source_metadata_for_validation(schema_version):
     """Retrieving source metadata from MetadataLedger that needs to be
         validated"""
     logger.info(
         "Accessing source metadata from MetadataLedger to be validated")
+    # records are validated again only when their hash or the schema changed
     source_data_dict = MetadataLedger.objects.values(
-        'source_metadata').filter(source_metadata_validation_status='',
-                                  record_lifecycle_status='Active'
-                                  ).exclude(
+        'source_metadata').filter(
+        ~Q(source_metadata_validation_fingerprint=get_validation_fingerprint(
+            'source_metadata_hash', schema_version)),
+        record_lifecycle_status='Active').exclude(
         source_metadata_extraction_date=None)
 
     return source_data_dict
 
 
 def store_source_metadata_validation_status(source_data_dict,
-                                            key_value_hash, validation_result,
-                                            record_status_result):
-    """Storing validation result in MetadataLedger"""
+                                            key_value_hashes,
+                                            validation_result,
+                                            record_status_result,
+                                            validation_date,
+                                            schema_version=None):
+    """Storing validation result of records in MetadataLedger"""
 
     source_data_dict.filter(
-        source_metadata_key_hash=key_value_hash).update(
+        source_metadata_key_hash__in=key_value_hashes).update(
         source_metadata_validation_status=validation_result,
-        source_metadata_validation_date=timezone.now(),
+        source_metadata_validation_date=validation_date,
+        source_metadata_validation_fingerprint=get_validation_fingerprint(
+            'source_metadata_hash', schema_version),
         record_lifecycle_status=record_status_result,
-        metadata_record_inactivation_date=timezone.now()
+        metadata_record_inactivation_date=validation_date
     )
 
 
-def validate_source_using_key(source_data_dict, required_column_list,
-                              recommended_column_list):
-    """Validating source data against required & recommended column names"""
+def validate_source_record(source_record, compiled_schema, report):
+    """Validating one source record against required & recommended column
+    names and returning its key and validation result"""
+    # Updating default validation for the record
+    key = get_key_dict(None, None)
+    validation_result = 'Y'
+    record_status_result = 'Active'
+    missing_required = []
+    missing_recommended = []
+    # looping in source metadata
+    for table_column_name in source_record:
+        # flattened source data created for reference
+        flattened_source_data = dict_flatten(source_record[table_column_name],
+                                             compiled_schema)
+        # validate for required values in data
+        for item in compiled_schema.required_fields:
+            # update validation and record status for invalid data
+            if not flattened_source_data.get(item):
+                validation_result = 'N'
+                record_status_result = 'Inactive'
+                missing_required.append(item)
+        # validate for recommended values in data
+        for item in compiled_schema.recommended_fields:
+            if not flattened_source_data.get(item):
+                missing_recommended.append(item)
+
+        # Key creation for source metadata
+        key = get_source_metadata_key_value(source_record[table_column_name])
+    # Counting missing values in the report instead of logging each of them
+    report.add_record(key['key_value'], missing_required, missing_recommended)
+    return key, validation_result, record_status_result
+
+
+def validate_source_using_key(source_data_dict, compiled_schema,
+                              batch_size=VALIDATION_BATCH_SIZE, report=None):
+    """Validating source data against required & recommended column names
+    of the compiled schema and returning report of missing fields"""
 
     logger.info("Validating and updating records in MetadataLedger table for "
                 "Source data")
-    len_source_metadata = len(source_data_dict)
-    for ind in range(len_source_metadata):
-        # Updating default validation for all records
-        key = get_key_dict(None, None)
-        validation_result = 'Y'
-        record_status_result = 'Active'
-        # looping in source metadata
-        for table_column_name in source_data_dict[ind]:
-            # flattened source data created for reference
-            flattened_source_data = dict_flatten(source_data_dict[ind]
-                                                 [table_column_name],
-                                                 required_column_list)
-            # validate for required values in data
-            for item in required_column_list:
-                # update validation and record status for invalid data
-                # Log out error for missing required values
-                if not flattened_source_data[item]:
-                    validation_result = 'N'
-                    record_status_result = 'Inactive'
-                    required_recommended_logs(ind, "Required", item)
-            # validate for recommended values in data
-            for item in recommended_column_list:
-                # Log out warning for missing recommended values
-                if not flattened_source_data[item]:
-                    required_recommended_logs(ind, "Recommended", item)
-
-            # Key creation for source metadata
-            key = \
-                get_source_metadata_key_value(source_data_dict[ind]
-                                              [table_column_name])
-        # Calling function to update validation status
-        store_source_metadata_validation_status(source_data_dict,
-                                                key['key_value_hash'],
-                                                validation_result,
-                                                record_status_result)
+    if report is None:
+        report = ValidationReport('source', compiled_schema.version)
+    # validation results waiting to be stored
+    validation_results = []
+    # Storing all validation results of the run in one transaction
+    with transaction.atomic():
+        # Streaming records from MetadataLedger one page at a time
+        for source_record in iterate_ledger(source_data_dict):
+            key, validation_result, record_status_result = \
+                validate_source_record(source_record, compiled_schema,
+                                       report)
+            validation_results.append((key['key_value_hash'],
+                                       validation_result,
+                                       record_status_result))
+            # Calling function to update validation status of a full batch
+            if len(validation_results) == batch_size:
+                store_validation_results(
+                    source_data_dict, validation_results,
+                    store_source_metadata_validation_status,
+                    compiled_schema.version)
+                validation_results = []
+
+        if validation_results:
+            store_validation_results(source_data_dict, validation_results,
+                                     store_source_metadata_validation_status,
+                                     compiled_schema.version)
+    return report
+
+
+def validate_source_chunk(compiled_schema, first_pk, last_pk, batch_size,
+                          sample_size):
+    """Validating source records of one range of primary keys in a worker
+    process and returning report of missing fields"""
+    source_data_dict = get_source_metadata_for_validation(
+        compiled_schema.version).filter(pk__gte=first_pk, pk__lte=last_pk)
+    return validate_source_using_key(
+        source_data_dict, compiled_schema, batch_size,
+        report=ValidationReport('source', compiled_schema.version,
+                                sample_size))
+
+
+def validate_source_in_process_pool(source_data_dict, compiled_schema,
+                                    workers, batch_size, report=None):
+    """Validating source data in chunks of primary keys spread over a pool of
+    worker processes and returning merged report of missing fields"""
+    if report is None:
+        report = ValidationReport('source', compiled_schema.version)
+    arguments_list = [(compiled_schema, first_pk, last_pk, batch_size,
+                       report.sample_size)
+                      for first_pk, last_pk in get_ledger_pk_ranges(
+                          source_data_dict, VALIDATION_CHUNK_SIZE)]
+    logger.info("Validating " + str(len(arguments_list)) + " chunks of "
+                "source records in " + str(workers) + " worker processes")
+    for chunk_report in run_in_process_pool(validate_source_chunk,
+                                            arguments_list, workers):
+        report.merge(chunk_report)
+    return report
 
 
 class Command(BaseCommand):
     """Django command to validate source data"""
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=VALIDATION_BATCH_SIZE,
+            help='Number of validation results written per query')
+        parser.add_argument(
+            '--sample-size', type=int, default=VALIDATION_SAMPLE_SIZE,
+            help='Number of records with missing fields kept as examples '
+                 'in the validation report')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of worker processes validating chunks of records')
+
     def handle(self, *args, **options):
         """
             Source data is validated and stored in metadataLedger
         """
-        schema_data_dict = get_source_validation_schema()
-        required_column_list, recommended_column_list = \
-            get_required_fields_for_validation(schema_data_dict)
-        source_data_dict = get_source_metadata_for_validation()
-        validate_source_using_key(source_data_dict, required_column_list,
-                                  recommended_column_list)
+        compiled_schema = compile_schema(get_source_validation_schema())
+        restore_source_metadata_validation_status(compiled_schema.version)
+        source_data_dict = get_source_metadata_for_validation(
+            compiled_schema.version)
+        report = ValidationReport(
+            'source', compiled_schema.version,
+            options.get('sample_size', VALIDATION_SAMPLE_SIZE))
+        workers = options.get('workers', 1)
+        batch_size = options.get('batch_size', VALIDATION_BATCH_SIZE)
+        if workers > 1:
+            validate_source_in_process_pool(source_data_dict, compiled_schema,
+                                            workers, batch_size, report)
+        else:
+            validate_source_using_key(source_data_dict, compiled_schema,
+                                      batch_size, report)
+        report.log()
+        report.save()
 
         logger.info(
             'MetadataLedger updated with source metadata validation status')
@@ -1,21 +1,130 @@
 import datetime
 import hashlib
+import json
 import logging
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from distutils.util import strtobool
 
-from core.models import XIAConfiguration
+from django.db import connections
+from django.db.models import CharField, F, QuerySet, Value
+from django.db.models.functions import MD5, Concat
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from core.models import (MetadataValidationReport, XIAConfiguration,
+                         XISConfiguration)
 
 logger = logging.getLogger('dict_config_logger')
 
+# field names depend on source data and SOURCESYSTEM is system generated
+SOURCE_METADATA_KEY_FIELDS = ['LearningResourceIdentifier', 'SOURCESYSTEM']
+
+# number of ledger records read per query while iterating over a ledger
+LEDGER_PAGE_SIZE = 500
+
+# number of records with missing fields kept as examples in a validation
+# report
+VALIDATION_SAMPLE_SIZE = 10
+
+# number of validation results written per query
+VALIDATION_BATCH_SIZE = 500
+
+
+# configuration values read by the workflow commands
+ConfigurationSnapshot = namedtuple('ConfigurationSnapshot', [
+    'publisher', 'source_metadata_schema', 'source_target_mapping',
+    'target_metadata_schema', 'source_file_format',
+    'xis_metadata_api_endpoint', 'xis_supplemental_api_endpoint'])
+
+# snapshot shared by all commands of a workflow run
+_configuration_snapshot = None
+
+
+def load_configuration_snapshot():
+    """Function to load values of XIA and XIS configuration into an
+    immutable snapshot"""
+    logger.debug("Loading snapshot of XIA and XIS configuration")
+    xia_data = XIAConfiguration.objects.first()
+    xis_data = XISConfiguration.objects.first()
+    return ConfigurationSnapshot(
+        publisher=getattr(xia_data, 'publisher', None),
+        source_metadata_schema=getattr(xia_data, 'source_metadata_schema',
+                                       None),
+        source_target_mapping=getattr(xia_data, 'source_target_mapping',
+                                      None),
+        target_metadata_schema=getattr(xia_data, 'target_metadata_schema',
+                                       None),
+        source_file_format=getattr(xia_data, 'source_file_format', None),
+        xis_metadata_api_endpoint=getattr(
+            xis_data, 'xis_metadata_api_endpoint', None),
+        xis_supplemental_api_endpoint=getattr(
+            xis_data, 'xis_supplemental_api_endpoint', None))
+
+
+def get_configuration_snapshot():
+    """Function to retrieve configuration snapshot, loading it on first
+    use"""
+    global _configuration_snapshot
+    if _configuration_snapshot is None:
+        _configuration_snapshot = load_configuration_snapshot()
+    return _configuration_snapshot
+
+
+def clear_configuration_snapshot():
+    """Function to discard configuration snapshot so the next use loads
+    the current configuration"""
+    global _configuration_snapshot
+    _configuration_snapshot = None
+
 
 def get_publisher_detail():
     """Retrieve publisher from XIA configuration """
     logger.debug("Retrieve publisher from XIA configuration")
-    xia_data = XIAConfiguration.objects.first()
-    publisher = xia_data.publisher
+    publisher = get_configuration_snapshot().publisher
     return publisher
 
 
+def normalize_metadata_value(value):
+    """Function to normalize scalar metadata values so equal values are
+    always serialized the same way"""
+    # NaN and NaT are the only values not equal to themselves
+    if value != value:
+        return None
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    # converting numpy scalars to python scalars
+    if hasattr(value, 'item') and callable(value.item):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def normalize_metadata(data):
+    """Function to normalize all values of nested metadata"""
+    if isinstance(data, dict):
+        return {str(key): normalize_metadata(value)
+                for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [normalize_metadata(value) for value in data]
+    return normalize_metadata_value(data)
+
+
+def get_metadata_bytes(data):
+    """Function to serialize metadata canonically with sorted keys"""
+    return json.dumps(normalize_metadata(data), sort_keys=True,
+                      separators=(',', ':'), ensure_ascii=False,
+                      default=str).encode('utf-8')
+
+
+def get_metadata_hash(data):
+    """Function to create hash of metadata which does not depend on key
+    order or value formatting"""
+    return hashlib.blake2b(get_metadata_bytes(data),
+                           digest_size=16).hexdigest()
+
+
 def get_key_dict(key_value, key_value_hash):
     """Creating key dictionary with all corresponding key values"""
     key = {'key_value': key_value, 'key_value_hash': key_value_hash}
@@ -24,11 +133,9 @@ def get_key_dict(key_value, key_value_hash):
 
 def get_source_metadata_key_value(data_dict):
     """Function to create key value for source metadata """
-    # field names depend on source data and SOURCESYSTEM is system generated
-    field = ['LearningResourceIdentifier', 'SOURCESYSTEM']
     field_values = []
 
-    for item in field:
+    for item in SOURCE_METADATA_KEY_FIELDS:
         if not data_dict.get(item):
             logger.info('Field name ' + item + ' is missing for '
                                                'key creation')
@@ -113,24 +220,240 @@ def get_target_metadata_key_value(data_dict):
     return key
 
 
-def required_recommended_logs(id_num, category, field):
-    """logs the missing required and recommended """
-
-    # Logs the missing required columns
-    if category == 'Required':
-        logger.error(
-            "Record " + str(
-                id_num) + " does not have all " + category +
-            " fields."
-            + field + " field is empty")
-
-    # Logs the missing recommended columns
-    if category == 'Recommended':
-        logger.warning(
-            "Record " + str(
-                id_num) + " does not have all " + category +
-            " fields."
-            + field + " field is empty")
+class ValidationReport:
+    """Missing required and recommended fields counted per field and per
+    record over one validation run"""
+
+    def __init__(self, validation_stage, schema_version=None,
+                 sample_size=VALIDATION_SAMPLE_SIZE):
+        self.validation_stage = validation_stage
+        self.schema_version = schema_version
+        self.sample_size = sample_size
+        self.record_count = 0
+        # records missing required fields fail validation
+        self.invalid_record_count = 0
+        # records missing recommended fields only
+        self.incomplete_record_count = 0
+        self.missing_required_fields = Counter()
+        self.missing_recommended_fields = Counter()
+        self.examples = []
+
+    def add_record(self, key_value, missing_required, missing_recommended):
+        """Counting missing fields of one validated record"""
+        self.record_count += 1
+        if missing_required:
+            self.invalid_record_count += 1
+        elif missing_recommended:
+            self.incomplete_record_count += 1
+        self.missing_required_fields.update(missing_required)
+        self.missing_recommended_fields.update(missing_recommended)
+        if (missing_required or missing_recommended) and \
+                len(self.examples) < self.sample_size:
+            self.examples.append({'record': key_value,
+                                  'missing_required': list(missing_required),
+                                  'missing_recommended':
+                                      list(missing_recommended)})
+
+    def merge(self, report):
+        """Adding counts of another report of the same run"""
+        self.record_count += report.record_count
+        self.invalid_record_count += report.invalid_record_count
+        self.incomplete_record_count += report.incomplete_record_count
+        self.missing_required_fields.update(report.missing_required_fields)
+        self.missing_recommended_fields.update(
+            report.missing_recommended_fields)
+        self.examples.extend(
+            report.examples[:self.sample_size - len(self.examples)])
+        return self
+
+    def log(self):
+        """Logging aggregated missing fields of the run"""
+        logger.info("Validated " + str(self.record_count) + " " +
+                    self.validation_stage + " records, " +
+                    str(self.invalid_record_count) +
+                    " missing required fields and " +
+                    str(self.incomplete_record_count) +
+                    " missing recommended fields only")
+        for field, count in self.missing_required_fields.most_common():
+            logger.error(str(count) + " records do not have Required field "
+                         + field)
+        for field, count in self.missing_recommended_fields.most_common():
+            logger.warning(str(count) + " records do not have Recommended "
+                                        "field " + field)
+
+    def save(self):
+        """Storing summary of the run in MetadataValidationReport"""
+        return MetadataValidationReport.objects.create(
+            validation_stage=self.validation_stage,
+            schema_version=self.schema_version or '',
+            record_count=self.record_count,
+            invalid_record_count=self.invalid_record_count,
+            incomplete_record_count=self.incomplete_record_count,
+            missing_required_fields=dict(self.missing_required_fields),
+            missing_recommended_fields=dict(
+                self.missing_recommended_fields),
+            examples=self.examples)
+
+
+class CompiledSchema:
+    """Required and recommended fields of a schema compiled once for
+    validation and transformation"""
+
+    def __init__(self, required_fields, recommended_fields=(), fields=None,
+                 version=None):
+        self.required_fields = tuple(required_fields)
+        self.recommended_fields = tuple(recommended_fields)
+        self.required_field_set = frozenset(self.required_fields)
+        self.recommended_field_set = frozenset(self.recommended_fields)
+        self.fields = tuple(fields) if fields is not None else \
+            self.required_fields + self.recommended_fields
+        self.version = version
+        # required fields by prefix, filled in on first use of each prefix
+        self.prefix_index = {}
+
+    def is_required(self, field):
+        """Checking if field is required"""
+        return field in self.required_field_set
+
+    def is_recommended(self, field):
+        """Checking if field is recommended"""
+        return field in self.recommended_field_set
+
+    def get_required_fields_with_prefix(self, prefix):
+        """Retrieving required fields starting with prefix"""
+        required_fields = self.prefix_index.get(prefix)
+        if required_fields is None:
+            required_fields = tuple(field for field in self.required_fields
+                                    if field.startswith(prefix))
+            self.prefix_index[prefix] = required_fields
+        return required_fields
+
+
+# compiled schemas of this process by schema version
+_compiled_schemas = {}
+
+
+def compile_schema(schema_data_dict):
+    """Function to compile schema, reusing the compiled schema of the same
+    schema version"""
+    version = get_metadata_hash(schema_data_dict)
+    compiled_schema = _compiled_schemas.get(version)
+    if compiled_schema is None:
+        flattened_schema_dict = dict_flatten(schema_data_dict, [])
+        compiled_schema = CompiledSchema(
+            [column for column, value in flattened_schema_dict.items()
+             if value == "Required"],
+            [column for column, value in flattened_schema_dict.items()
+             if value == "Recommended"],
+            flattened_schema_dict, version)
+        _compiled_schemas[version] = compiled_schema
+    return compiled_schema
+
+
+# instruction copying the value of a source field to a target field
+MappingInstruction = namedtuple('MappingInstruction', [
+    'target_section', 'target_field', 'source_path'])
+
+
+class CompiledMapping:
+    """Target mapping schema compiled once into instructions copying source
+    fields to target fields"""
+
+    def __init__(self, instructions, target_sections=(), version=None):
+        self.instructions = tuple(instructions)
+        self.target_sections = tuple(target_sections)
+        # source fields mapped to a target field are not supplemental
+        self.source_paths = frozenset(
+            instruction.source_path for instruction in self.instructions
+            if isinstance(instruction.source_path, str))
+        self.version = version
+
+    def apply(self, source_metadata):
+        """Creating target metadata from flattened source metadata"""
+        target_metadata = {target_section: {}
+                           for target_section in self.target_sections}
+        for target_section, target_field, source_path in self.instructions:
+            # source paths which are not source fields are copied as they are
+            value = source_metadata.get(source_path, source_path) \
+                if isinstance(source_path, str) else source_path
+            # floats keep the precision they were serialized to json with
+            if isinstance(value, float):
+                value = round(value, 10)
+            target_metadata[target_section][target_field] = value
+        return target_metadata
+
+
+# compiled mappings of this process by mapping version
+_compiled_mappings = {}
+
+
+def compile_mapping(target_mapping_dict):
+    """Function to compile target mapping schema, reusing the compiled
+    mapping of the same mapping version"""
+    if isinstance(target_mapping_dict, CompiledMapping):
+        return target_mapping_dict
+    version = get_metadata_hash(target_mapping_dict)
+    compiled_mapping = _compiled_mappings.get(version)
+    if compiled_mapping is None:
+        # target fields are ordered by the first section mapping them and
+        # target sections by the first field they map, the same way the
+        # mapping schema was ordered as a dataframe
+        target_fields = list(dict.fromkeys(
+            target_field for target_section in target_mapping_dict.values()
+            for target_field in target_section))
+        target_sections = list(dict.fromkeys(
+            target_section for target_field in target_fields
+            for target_section in target_mapping_dict
+            if target_field in target_mapping_dict[target_section]))
+        # target fields without a source path are left out
+        compiled_mapping = CompiledMapping(
+            [MappingInstruction(target_section, target_field,
+                                target_mapping_dict[target_section][
+                                    target_field])
+             for target_section in target_sections
+             for target_field in target_fields
+             if target_mapping_dict[target_section].get(target_field)
+             is not None],
+            target_sections, version)
+        _compiled_mappings[version] = compiled_mapping
+    return compiled_mapping
+
+
+def get_validation_fingerprint(hash_field, schema_version):
+    """Function to create database expression of the validation fingerprint
+    of records from their hash field and the schema version"""
+    # the fingerprint changes when either the record or the schema changes
+    return MD5(Concat(F(hash_field),
+                      Value(':' + str(schema_version or ''),
+                            output_field=CharField())))
+
+
+def store_validation_results(data_dict, validation_results,
+                             store_validation_status, schema_version=None):
+    """Function to store accumulated validation results of records in
+    MetadataLedger with one update per outcome, using the validation status
+    writer of the validated metadata"""
+    key_value_hashes_by_result = {}
+    for key_value_hash, validation_result, record_status_result in \
+            validation_results:
+        key_value_hashes_by_result.setdefault(
+            (validation_result, record_status_result), []).append(
+            key_value_hash)
+
+    validation_date = timezone.now()
+    for (validation_result, record_status_result), key_value_hashes in \
+            key_value_hashes_by_result.items():
+        store_validation_status(data_dict, key_value_hashes,
+                                validation_result, record_status_result,
+                                validation_date, schema_version)
+
+
+def get_required_fields_with_prefix(required_column_list, prefix):
+    """function to find required column names starting with prefix"""
+    if isinstance(required_column_list, CompiledSchema):
+        return required_column_list.get_required_fields_with_prefix(prefix)
+    return [required_prefix for required_prefix in required_column_list
+            if required_prefix.startswith(prefix)]
 
 
 def dict_flatten(data_dict, required_column_list):
@@ -160,7 +483,9 @@ def dict_flatten(data_dict, required_column_list):
 
 def flatten_list_object(list_obj, prefix, flatten_dict, required_column_list):
     """function to flatten list object"""
-    required_prefix_list = []
+    # required column names with matching prefix
+    required_prefix_list = get_required_fields_with_prefix(
+        required_column_list, prefix)
     for i in range(len(list_obj)):
         #  storing initial flatten_dict for resetting values
         if not i:
@@ -180,23 +505,13 @@ def flatten_list_object(list_obj, prefix, flatten_dict, required_column_list):
         else:
             update_flattened_object(list_obj[i], prefix, flatten_dict)
 
-        # looping through required column names
-        for required_prefix in required_column_list:
-            # finding matching value along with index
-            try:
-                required_prefix.index(prefix)
-            except ValueError:
-                continue
-            else:
-                if required_prefix.index(prefix) == 0:
-                    required_prefix_list.append(required_prefix)
         #  setting up flag for checking validation
         passed = True
 
         # looping through items in required columns with matching prefix
         for item_to_check in required_prefix_list:
             #  flag if value not found
-            if not flatten_dict[item_to_check]:
+            if not flatten_dict.get(item_to_check):
                 passed = False
 
         # if all required values are skip other object in list
@@ -228,7 +543,7 @@ def update_flattened_object(str_obj, prefix, flatten_dict):
 
 def convert_date_to_isoformat(date):
     """function to convert date to ISO format"""
-    if isinstance(date, datetime.datetime):
+    if isinstance(date, (datetime.date, datetime.time)):
         date = date.isoformat()
     return date
 
@@ -251,4 +566,78 @@ def type_cast_overwritten_values(field_type, field_value):
             logger.error("Field Value " + field_value +
                          " and Field Data type " + field_type +
                          " do not match")
+    if field_type == "datetime":
+        try:
+            value = parse_datetime(field_value)
+            if value is None:
+                value = datetime.datetime.combine(parse_date(field_value),
+                                                  datetime.time())
+        except (TypeError, ValueError):
+            value = field_value
+            logger.error("Field Value " + field_value +
+                         " and Field Data type " + field_type +
+                         " do not match")
     return value
+
+
+def iterate_in_process_pool(function, arguments_list, workers):
+    """Function to call function with each set of arguments in a pool of
+    worker processes and yield the results in order as they complete"""
+    # worker processes must open database connections of their own
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = deque(executor.submit(function, *arguments)
+                        for arguments in arguments_list)
+        # results are released once they are yielded
+        while futures:
+            yield futures.popleft().result()
+
+
+def run_in_process_pool(function, arguments_list, workers):
+    """Function to call function with each set of arguments in a pool of
+    worker processes and return the results in order"""
+    return list(iterate_in_process_pool(function, arguments_list, workers))
+
+
+def iterate_ledger(queryset, page_size=LEDGER_PAGE_SIZE):
+    """Function to stream records of a ledger queryset in pages of primary
+    key ranges, so only one page of records is held in memory"""
+    # records which are not queried from a ledger are already in memory
+    if not isinstance(queryset, QuerySet):
+        yield from queryset
+        return
+
+    # columns selected with values() are read along with the primary key
+    fields = list(queryset.query.values_select)
+    page_queryset = queryset.order_by('pk')
+    if fields:
+        page_queryset = page_queryset.values('pk', *fields)
+    last_pk = None
+    while True:
+        if last_pk is not None:
+            page = list(page_queryset.filter(pk__gt=last_pk)[:page_size])
+        else:
+            page = list(page_queryset[:page_size])
+        for record in page:
+            yield {field: record[field] for field in fields} if fields \
+                else record
+        if len(page) < page_size:
+            return
+        last_pk = page[-1]['pk'] if fields else page[-1].pk
+
+
+def get_ledger_pk_ranges(queryset, chunk_size):
+    """Function to split records of a ledger queryset into ranges of
+    primary keys holding chunk_size records each"""
+    pk_ranges = []
+    first_pk = last_pk = None
+    for ind, pk in enumerate(queryset.order_by('pk').values_list(
+            'pk', flat=True).iterator(chunk_size=LEDGER_PAGE_SIZE)):
+        if ind % chunk_size == 0:
+            if first_pk is not None:
+                pk_ranges.append((first_pk, last_pk))
+            first_pk = pk
+        last_pk = pk
+    if first_pk is not None:
+        pk_ranges.append((first_pk, last_pk))
+    return pk_ranges
@@ -2,7 +2,7 @@ import logging
 
 import requests
 
-from core.models import XISConfiguration
+from core.management.utils.xia_internal import get_configuration_snapshot
 
 logger = logging.getLogger('dict_config_logger')
 
@@ -11,8 +11,8 @@ def get_xis_metadata_api_endpoint():
     """Retrieve xis metadata api endpoint from XIS configuration """
     logger.debug("Retrieve XIS metadata ledger api endpoint from "
                  "XIS configuration")
-    xis_data = XISConfiguration.objects.first()
-    xis_metadata_api_endpoint = xis_data.xis_metadata_api_endpoint
+    xis_metadata_api_endpoint = \
+        get_configuration_snapshot().xis_metadata_api_endpoint
     return xis_metadata_api_endpoint
 
 
@@ -20,8 +20,8 @@ def get_xis_supplemental_metadata_api_endpoint():
     """Retrieve xis supplemental api endpoint from XIS configuration """
     logger.debug("Retrieve XIS supplemental ledger api endpoint from "
                  "XIS configuration")
-    xis_data = XISConfiguration.objects.first()
-    xis_supplemental_api_endpoint = xis_data.xis_supplemental_api_endpoint
+    xis_supplemental_api_endpoint = \
+        get_configuration_snapshot().xis_supplemental_api_endpoint
 
     return xis_supplemental_api_endpoint
 
@@ -1,22 +1,180 @@
+import hashlib
+import json
 import logging
+import os
 
 import pandas as pd
+from openpyxl import load_workbook
 
+from core.management.utils.xia_internal import get_configuration_snapshot
 from core.models import XIAConfiguration
 
 logger = logging.getLogger('dict_config_logger')
 
+# number of source rows held in memory at a time while streaming
+SOURCE_CHUNK_SIZE = 1000
 
-def read_source_file():
-    """setting file path from s3 bucket"""
+
+def get_source_file_fingerprint(source_file):
+    """Creating fingerprint of the source file from its storage attributes"""
+    fingerprint = {'source_file_name': source_file.name,
+                   'source_file_size': source_file.size,
+                   'source_file_modified': None,
+                   'source_file_etag': ''}
+    try:
+        fingerprint['source_file_modified'] = \
+            source_file.storage.get_modified_time(source_file.name)
+    except NotImplementedError:
+        logger.debug("Source file storage does not provide modified time")
+    # files in s3 buckets come with an ETag of their content
+    s3_object = getattr(source_file.file, 'obj', None)
+    fingerprint['source_file_etag'] = getattr(s3_object, 'e_tag', '') or ''
+    return fingerprint
+
+
+def get_source_file_digest(source_file):
+    """Creating digest of the source file content"""
+    digest = hashlib.blake2b(digest_size=16)
+    with source_file.storage.open(source_file.name, 'rb') as content:
+        for file_chunk in content.chunks():
+            digest.update(file_chunk)
+    return digest.hexdigest()
+
+
+def get_source_file_columns(header_row):
+    """Creating column names from the header row of the source file"""
+    # unnamed columns are named the same way pandas.read_excel names them
+    return ['Unnamed: ' + str(ind) if column is None else str(column)
+            for ind, column in enumerate(header_row)]
+
+
+def create_source_chunk(columns, rows):
+    """Creating dataframe from a chunk of source rows"""
+    source_chunk = pd.DataFrame.from_records(rows, columns=columns)
+    return source_chunk.where(pd.notnull(source_chunk), None)
+
+
+def get_source_files():
+    """Retrieve source file and source files of catalog segments from XIA
+    configuration"""
     xia_data = XIAConfiguration.objects.first()
-    file_name = xia_data.source_file
-    extracted_data = pd.read_excel(file_name, engine='openpyxl')
-    std_source_df = extracted_data.where(pd.notnull(extracted_data),
-                                         None)
-    #  Creating list of dataframes of sources
-    source_list = [std_source_df]
-
-    logger.debug("Sending source data in dataframe format for EVTVL")
-    # file_name.delete()
-    return source_list
+    source_files = [xia_data.source_file]
+    source_files.extend(segment.source_file
+                        for segment in xia_data.source_files.all())
+    return [source_file for source_file in source_files if source_file]
+
+
+def get_source_file_format(source_file):
+    """Retrieve source file format from XIA configuration or from the
+    extension of the source file"""
+    source_file_format = get_configuration_snapshot().source_file_format
+    if not source_file_format:
+        extension = os.path.splitext(source_file.name)[1].lstrip('.').lower()
+        source_file_format = SOURCE_FILE_EXTENSIONS.get(extension, extension)
+    return source_file_format
+
+
+def read_xlsx_source_in_chunks(source_file, chunk_size, columns=None):
+    """Streaming rows of xlsx source file as dataframe chunks"""
+    # read only mode keeps just the rows being iterated over in memory
+    workbook = load_workbook(source_file, read_only=True, data_only=True)
+    try:
+        source_rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header_row = next(source_rows, None)
+        if header_row is None:
+            logger.error("Source file does not have a header row!")
+            return
+        header_columns = get_source_file_columns(header_row)
+        # positions of the columns to be read from each row
+        column_positions = [ind for ind, column in enumerate(header_columns)
+                            if columns is None or column in columns]
+        header_columns = [header_columns[ind] for ind in column_positions]
+
+        rows = []
+        for row in source_rows:
+            # skipping blank rows the same way pandas.read_excel does
+            if all(value is None for value in row):
+                continue
+            rows.append([row[ind] for ind in column_positions])
+            if len(rows) == chunk_size:
+                yield create_source_chunk(header_columns, rows)
+                rows = []
+        if rows:
+            yield create_source_chunk(header_columns, rows)
+    finally:
+        workbook.close()
+
+
+def read_csv_source_in_chunks(source_file, chunk_size, columns=None):
+    """Streaming rows of csv source file as dataframe chunks"""
+    # csv values are untyped, so they are all kept as text
+    for source_chunk in pd.read_csv(
+            source_file, chunksize=chunk_size, dtype=str, engine='c',
+            usecols=None if columns is None else columns.__contains__):
+        yield source_chunk.where(pd.notnull(source_chunk), None)
+
+
+def read_jsonl_source_in_chunks(source_file, chunk_size, columns=None):
+    """Streaming lines of json lines source file as dataframe chunks"""
+    rows = []
+    for line in source_file:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if columns is not None:
+            row = {column: value for column, value in row.items()
+                   if column in columns}
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield create_source_chunk(None, rows)
+            rows = []
+    if rows:
+        yield create_source_chunk(None, rows)
+
+
+def read_parquet_source_in_chunks(source_file, chunk_size, columns=None):
+    """Streaming record batches of parquet source file as dataframe chunks"""
+    # pyarrow is only needed when the source is in parquet format
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(source_file)
+    if columns is not None:
+        # parquet only reads the column chunks that are asked for
+        columns = [column for column in parquet_file.schema_arrow.names
+                   if column in columns]
+    for record_batch in parquet_file.iter_batches(batch_size=chunk_size,
+                                                  columns=columns):
+        source_chunk = record_batch.to_pandas()
+        yield source_chunk.where(pd.notnull(source_chunk), None)
+
+
+# source file readers by source file format
+SOURCE_FILE_READERS = {
+    'xlsx': read_xlsx_source_in_chunks,
+    'csv': read_csv_source_in_chunks,
+    'jsonl': read_jsonl_source_in_chunks,
+    'parquet': read_parquet_source_in_chunks,
+}
+
+# source file formats of file extensions not named after their format
+SOURCE_FILE_EXTENSIONS = {
+    'ndjson': 'jsonl',
+    'pq': 'parquet',
+}
+
+
+def read_source_file_in_chunks(source_file, source_file_format='xlsx',
+                               chunk_size=SOURCE_CHUNK_SIZE, columns=None):
+    """Streaming source file rows from s3 bucket as dataframe chunks,
+    reading only the given columns when columns are set"""
+    source_file_reader = SOURCE_FILE_READERS.get(source_file_format)
+    if not source_file_reader:
+        logger.error("Source file format " + str(source_file_format) +
+                     " is not supported")
+        raise SystemExit('Exiting! Can not read source file.')
+
+    for source_chunk in source_file_reader(source_file, chunk_size,
+                                           columns):
+        logger.debug("Sending source data chunk in dataframe format for "
+                     "EVTVL")
+        yield source_chunk
@@ -1,14 +1,22 @@
+import copy
+import hashlib
 import json
 import logging
 import os
 
 import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 
-from core.management.utils.xia_internal import dict_flatten
-from core.models import XIAConfiguration
+from core.management.utils.xia_internal import get_configuration_snapshot
 
 logger = logging.getLogger('dict_config_logger')
 
+# s3 resource shared by all schema reads of the process
+_s3_resource = None
+
+# schemas read in this process with their ETag, keyed by bucket and key
+_schema_cache = {}
+
 
 def get_aws_bucket_name():
     """function returns the source bucket name"""
@@ -16,22 +24,105 @@ def get_aws_bucket_name():
     return bucket
 
 
+def get_s3_resource():
+    """function returns the s3 resource, creating it on first use"""
+    global _s3_resource
+    if _s3_resource is None:
+        _s3_resource = boto3.resource('s3')
+    return _s3_resource
+
+
+def get_schema_cache_path(bucket_name, file_name):
+    """function returns the path of a schema in the on-disk cache, if the
+    cache directory is set"""
+    cache_dir = os.environ.get('SCHEMA_CACHE_DIR')
+    if not cache_dir:
+        return None
+    cache_name = hashlib.md5(
+        (str(bucket_name) + '/' + file_name).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, cache_name + '.json')
+
+
+def read_cached_schema(bucket_name, file_name):
+    """Retrieving ETag and content of a cached schema from memory or from
+    disk"""
+    cached_schema = _schema_cache.get((bucket_name, file_name))
+    cache_path = get_schema_cache_path(bucket_name, file_name)
+    if cached_schema or not cache_path or not os.path.exists(cache_path):
+        return cached_schema
+    try:
+        with open(cache_path, encoding='utf-8') as cache_file:
+            cache_entry = json.load(cache_file)
+        cached_schema = (cache_entry['etag'], cache_entry['data'])
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Ignoring cached schema " + file_name + ": " + str(e))
+        return None
+    _schema_cache[(bucket_name, file_name)] = cached_schema
+    return cached_schema
+
+
+def write_cached_schema(bucket_name, file_name, etag, data_dict):
+    """Storing ETag and content of a schema in memory and on disk"""
+    _schema_cache[(bucket_name, file_name)] = (etag, data_dict)
+    cache_path = get_schema_cache_path(bucket_name, file_name)
+    if not cache_path:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # replacing the cached file at once so readers never see half of it
+        with open(cache_path + '.tmp', 'w', encoding='utf-8') as cache_file:
+            json.dump({'etag': etag, 'data': data_dict}, cache_file)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:
+        logger.warning("Could not cache schema " + file_name + ": " + str(e))
+
+
+def read_local_json_data(local_dir, file_name):
+    """Ingesting json file of a local directory as dictionary values"""
+    with open(os.path.join(local_dir, file_name),
+              encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
 def read_json_data(file_name):
     """Setting file path for json files and ingesting as dictionary values """
-    s3 = boto3.resource('s3')
+    # schemas are read from a local directory when working offline
+    local_dir = os.environ.get('SCHEMA_LOCAL_DIR')
+    if local_dir:
+        return read_local_json_data(local_dir, file_name)
+
     bucket_name = get_aws_bucket_name()
+    cached_schema = read_cached_schema(bucket_name, file_name)
+    json_path = get_s3_resource().Object(bucket_name, file_name)
+    try:
+        # Only downloading the json file when it changed since it was cached
+        if cached_schema and cached_schema[0]:
+            response = json_path.get(IfNoneMatch=cached_schema[0])
+        else:
+            response = json_path.get()
+    except (BotoCoreError, ClientError) as e:
+        if not cached_schema:
+            raise
+        if not isinstance(e, ClientError) or \
+                e.response.get('Error', {}).get('Code') != '304':
+            logger.warning("Using cached schema " + file_name +
+                           " as it could not be read from S3: " + str(e))
+        # copies keep callers from changing the cached schema
+        return copy.deepcopy(cached_schema[1])
+
     # Read json file and store as a dictionary for processing
-    json_path = s3.Object(bucket_name, file_name)
-    json_content = json_path.get()['Body'].read().decode('utf-8')
+    json_content = response['Body'].read().decode('utf-8')
     data_dict = json.loads(json_content)
-    return data_dict
+    write_cached_schema(bucket_name, file_name, response.get('ETag'),
+                        data_dict)
+    return copy.deepcopy(data_dict)
 
 
 def get_source_validation_schema():
     """Retrieve source validation schema from XIA configuration """
     logger.info("Configuration of schemas and files for source")
-    xia_data = XIAConfiguration.objects.first()
-    source_validation_schema = xia_data.source_metadata_schema
+    source_validation_schema = \
+        get_configuration_snapshot().source_metadata_schema
     if not source_validation_schema:
         logger.warning("Source validation field name is empty!")
     logger.info("Reading schema for validation")
@@ -43,8 +134,8 @@ def get_source_validation_schema():
 def get_target_validation_schema():
     """Retrieve target validation schema from XIA configuration """
     logger.info("Configuration of schemas and files for target")
-    xia_data = XIAConfiguration.objects.first()
-    target_validation_schema = xia_data.target_metadata_schema
+    target_validation_schema = \
+        get_configuration_snapshot().target_metadata_schema
     if not target_validation_schema:
         logger.warning("Target validation field name is empty!")
     logger.info("Reading schema for validation")
@@ -53,32 +144,11 @@ def get_target_validation_schema():
     return schema_data_dict
 
 
-def get_required_fields_for_validation(schema_data_dict):
-    """Creating list of fields which are Required & Recommended"""
-
-    # Call function to flatten schema used for validation
-    flattened_schema_dict = dict_flatten(schema_data_dict, [])
-
-    # Declare list for required and recommended column names
-    required_column_list = list()
-    recommended_column_list = list()
-
-    #  Adding values to required and recommended list based on schema
-    for column, value in flattened_schema_dict.items():
-        if value == "Required":
-            required_column_list.append(column)
-        elif value == "Recommended":
-            recommended_column_list.append(column)
-
-    # Returning required and recommended list for validation
-    return required_column_list, recommended_column_list
-
-
 def get_target_metadata_for_transformation():
     """Retrieve target metadata schema from XIA configuration """
     logger.info("Configuration of schemas and files for transformation")
-    xia_data = XIAConfiguration.objects.first()
-    target_metadata_schema = xia_data.source_target_mapping
+    target_metadata_schema = \
+        get_configuration_snapshot().source_target_mapping
     if not target_metadata_schema:
         logger.warning("Target metadata schema field name is empty!")
     logger.info("Reading schema for transformation")
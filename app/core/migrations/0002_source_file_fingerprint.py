@@ -0,0 +1,32 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:01
+
+import django.utils.timezone
+import model_utils.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SourceFileFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('source_file_name', models.CharField(max_length=255, unique=True)),
+                ('source_file_size', models.BigIntegerField()),
+                ('source_file_modified', models.DateTimeField(blank=True, null=True)),
+                ('source_file_etag', models.CharField(blank=True, max_length=200)),
+                ('source_file_digest', models.CharField(max_length=200)),
+                ('extraction_settings_hash', models.CharField(max_length=200)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
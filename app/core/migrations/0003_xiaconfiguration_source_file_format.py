@@ -0,0 +1,18 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_source_file_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xiaconfiguration',
+            name='source_file_format',
+            field=models.CharField(blank=True, choices=[('', 'Detect from file extension'), ('xlsx', 'Excel workbook'), ('csv', 'CSV'), ('jsonl', 'JSON Lines'), ('parquet', 'Parquet')], default='', help_text='Select the format of the source file', max_length=10),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_xiaconfiguration_source_file_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SourceFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_file', models.FileField(help_text='Upload the source file of a catalog segment', upload_to='')),
+                ('xia_configuration', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='source_files', to='core.xiaconfiguration')),
+            ],
+        ),
+    ]
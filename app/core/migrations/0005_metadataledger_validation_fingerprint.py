@@ -0,0 +1,23 @@
+# Generated by Django 3.1.13 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_source_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadataledger',
+            name='source_metadata_validation_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='metadataledger',
+            name='target_metadata_validation_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.13 on 2026-10-18 11:30
+
+import django.utils.timezone
+import model_utils.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_metadataledger_validation_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetadataValidationReport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('validation_stage', models.CharField(choices=[('source', 'Source'), ('target', 'Target')], max_length=10)),
+                ('schema_version', models.CharField(blank=True, max_length=200)),
+                ('record_count', models.IntegerField(default=0)),
+                ('invalid_record_count', models.IntegerField(default=0)),
+                ('incomplete_record_count', models.IntegerField(default=0)),
+                ('missing_required_fields', models.JSONField(blank=True, default=dict)),
+                ('missing_recommended_fields', models.JSONField(blank=True, default=dict)),
+                ('examples', models.JSONField(blank=True, default=list)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.13 on 2026-10-18 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_metadata_validation_report'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadataledger',
+            name='source_metadata_transformation_hash',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='metadataledger',
+            name='target_mapping_version',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+    ]
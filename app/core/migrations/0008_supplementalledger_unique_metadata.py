@@ -0,0 +1,45 @@
+# Generated by Django 3.1.13 on 2026-10-18 12:10
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def remove_duplicate_supplemental_records(apps, schema_editor):
+    """Removing supplemental records stored again for the same key and
+    metadata hash, keeping the latest transformed record"""
+    SupplementalLedger = apps.get_model('core', 'SupplementalLedger')
+    seen_records = set()
+    duplicate_records = []
+    for record_uuid, key_value_hash, hash_value in \
+            SupplementalLedger.objects.order_by(
+                F('supplemental_metadata_transformation_date').desc(
+                    nulls_last=True),
+                '-supplemental_metadata_extraction_date',
+                'metadata_record_uuid').values_list(
+                'metadata_record_uuid', 'supplemental_metadata_key_hash',
+                'supplemental_metadata_hash').iterator():
+        if (key_value_hash, hash_value) in seen_records:
+            duplicate_records.append(record_uuid)
+        else:
+            seen_records.add((key_value_hash, hash_value))
+
+    for start in range(0, len(duplicate_records), 500):
+        SupplementalLedger.objects.filter(
+            metadata_record_uuid__in=duplicate_records[start:start + 500]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_metadataledger_transformation_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_supplemental_records,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='supplementalledger',
+            constraint=models.UniqueConstraint(fields=('supplemental_metadata_key_hash', 'supplemental_metadata_hash'), name='unique_supplemental_metadata'),
+        ),
+    ]
@@ -26,8 +26,18 @@ class XIAConfiguration(models.Model):
         help_text='Enter the target '
                   'schema file to '
                   'validate from.')
+    SOURCE_FILE_FORMAT_CHOICES = [('', 'Detect from file extension'),
+                                  ('xlsx', 'Excel workbook'),
+                                  ('csv', 'CSV'),
+                                  ('jsonl', 'JSON Lines'),
+                                  ('parquet', 'Parquet')]
+
     source_file = models.FileField(help_text='Upload the source '
                                              'file')
+    source_file_format = models.CharField(
+        max_length=10, blank=True, default='',
+        choices=SOURCE_FILE_FORMAT_CHOICES,
+        help_text='Select the format of the source file')
 
     def get_absolute_url(self):
         """ URL for displaying individual model records."""
@@ -44,6 +54,20 @@ class XIAConfiguration(models.Model):
         return super(XIAConfiguration, self).save(*args, **kwargs)
 
 
+class SourceFile(models.Model):
+    """Model for additional source files of XIA Configuration, one per
+    catalog segment"""
+    xia_configuration = models.ForeignKey(XIAConfiguration,
+                                          on_delete=models.CASCADE,
+                                          related_name='source_files')
+    source_file = models.FileField(help_text='Upload the source file of a '
+                                             'catalog segment')
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.source_file.name}'
+
+
 class XISConfiguration(models.Model):
     """Model for XIS Configuration """
 
@@ -121,14 +145,20 @@ class MetadataLedger(models.Model):
     source_metadata_key_hash = models.CharField(max_length=200)
     source_metadata_transformation_date = models.DateTimeField(blank=True,
                                                                null=True)
+    source_metadata_transformation_hash = models.CharField(
+        max_length=200, blank=True, default='')
     source_metadata_validation_date = models.DateTimeField(blank=True,
                                                            null=True)
+    source_metadata_validation_fingerprint = models.CharField(
+        max_length=200, blank=True, default='')
     source_metadata_validation_status = models.CharField(
         max_length=10, blank=True, choices=METADATA_VALIDATION_CHOICES)
     target_metadata = models.JSONField(default=dict)
     target_metadata_hash = models.CharField(max_length=200)
     target_metadata_key = models.TextField()
     target_metadata_key_hash = models.CharField(max_length=200)
+    target_mapping_version = models.CharField(max_length=200, blank=True,
+                                              default='')
     target_metadata_transmission_date = models.DateTimeField(blank=True,
                                                              null=True)
     target_metadata_transmission_status = models.CharField(
@@ -138,6 +168,8 @@ class MetadataLedger(models.Model):
                                                                    null=True)
     target_metadata_validation_date = models.DateTimeField(blank=True,
                                                            null=True)
+    target_metadata_validation_fingerprint = models.CharField(
+        max_length=200, blank=True, default='')
     target_metadata_validation_status = models.CharField(
         max_length=10, blank=True, choices=METADATA_VALIDATION_CHOICES)
 
@@ -171,6 +203,14 @@ class SupplementalLedger(models.Model):
     supplemental_metadata_transmission_status_code = models.IntegerField(
         blank=True, null=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['supplemental_metadata_key_hash',
+                        'supplemental_metadata_hash'],
+                name='unique_supplemental_metadata'),
+        ]
+
 
 class MetadataFieldOverwrite(TimeStampedModel):
     """Model for taking list of fields name and it's values for overwriting
@@ -195,3 +235,38 @@ class MetadataFieldOverwrite(TimeStampedModel):
 
     def save(self, *args, **kwargs):
         return super(MetadataFieldOverwrite, self).save(*args, **kwargs)
+
+
+class SourceFileFingerprint(TimeStampedModel):
+    """Model for fingerprint of the last extracted source file"""
+
+    source_file_name = models.CharField(max_length=255, unique=True)
+    source_file_size = models.BigIntegerField()
+    source_file_modified = models.DateTimeField(blank=True, null=True)
+    source_file_etag = models.CharField(max_length=200, blank=True)
+    source_file_digest = models.CharField(max_length=200)
+    extraction_settings_hash = models.CharField(max_length=200)
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.source_file_name}'
+
+
+class MetadataValidationReport(TimeStampedModel):
+    """Model for summary of missing fields found by one validation run"""
+
+    VALIDATION_STAGE_CHOICES = [('source', 'Source'), ('target', 'Target')]
+
+    validation_stage = models.CharField(max_length=10,
+                                        choices=VALIDATION_STAGE_CHOICES)
+    schema_version = models.CharField(max_length=200, blank=True)
+    record_count = models.IntegerField(default=0)
+    invalid_record_count = models.IntegerField(default=0)
+    incomplete_record_count = models.IntegerField(default=0)
+    missing_required_fields = models.JSONField(default=dict, blank=True)
+    missing_recommended_fields = models.JSONField(default=dict, blank=True)
+    examples = models.JSONField(default=list, blank=True)
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.validation_stage} {self.created}'
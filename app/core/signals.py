@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from core.management.utils.xia_internal import clear_configuration_snapshot
+from core.models import XIAConfiguration, XISConfiguration
+
+
+@receiver([post_save, post_delete], sender=XIAConfiguration)
+@receiver([post_save, post_delete], sender=XISConfiguration)
+def invalidate_configuration_snapshot(sender, **kwargs):
+    """Discarding configuration snapshot when configuration is changed"""
+    clear_configuration_snapshot()
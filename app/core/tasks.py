@@ -16,6 +16,7 @@ from core.management.commands.validate_source_metadata import \
     Command as validate_source_Command
 from core.management.commands.validate_target_metadata import \
     Command as validate_target_Command
+from core.management.utils.xia_internal import clear_configuration_snapshot
 
 logger = logging.getLogger('dict_config_logger')
 
@@ -24,6 +25,9 @@ logger = logging.getLogger('dict_config_logger')
 def execute_xia_automated_workflow():
     """XIA automated workflow"""
     logger.info('STARTING WORKFLOW')
+    # Loading configuration once for all commands of this run, as changes
+    # saved by other processes do not reach this worker
+    clear_configuration_snapshot()
 
     extract_class = extract_Command()
     validate_source_class = validate_source_Command()
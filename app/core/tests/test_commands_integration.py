@@ -1,22 +1,38 @@
+import json
 import logging
+import pickle
 from unittest.mock import patch
 
 import pandas as pd
 from ddt import ddt
+from django.core.files.base import ContentFile
 from django.test import tag
 from django.utils import timezone
 
 from core.management.commands.extract_source_metadata import (
-    extract_metadata_using_key, store_source_metadata)
+    extract_metadata_using_key, get_active_source_key_index,
+    get_source_metadata, get_source_metadata_record,
+    inactivate_removed_source_records, is_source_file_unchanged,
+    store_source_file_fingerprint, store_source_metadata)
 from core.management.commands.load_target_metadata import (
     post_data_to_xis, rename_metadata_ledger_fields)
+from core.management.commands.rehash_metadata_ledger import \
+    rehash_metadata_ledger
 from core.management.commands.transform_source_metadata import (
+    get_source_metadata_for_transformation,
     get_target_metadata_for_transformation, transform_source_using_key)
 from core.management.commands.validate_source_metadata import (
     get_source_metadata_for_validation, get_source_validation_schema,
+    restore_source_metadata_validation_status, validate_source_in_process_pool,
     validate_source_using_key)
 from core.management.commands.validate_target_metadata import (
     get_target_validation_schema, validate_target_using_key)
+from core.management.utils.xia_internal import (CompiledSchema,
+                                                compile_mapping,
+                                                get_ledger_pk_ranges,
+                                                get_metadata_hash,
+                                                get_source_metadata_key_value,
+                                                iterate_ledger)
 from core.management.utils.xss_client import read_json_data
 from core.models import (MetadataLedger, SupplementalLedger, XIAConfiguration,
                          XISConfiguration)
@@ -36,9 +52,9 @@ class CommandIntegration(TestSetUp):
     def test_store_source_metadata(self):
         """Test to extract data from Experience Source Repository(XSR)
         and store in metadata ledger """
-        store_source_metadata(self.key_value, self.key_value_hash,
-                              self.hash_value,
-                              self.source_metadata)
+        store_source_metadata([get_source_metadata_record(
+            self.key_value, self.key_value_hash, self.hash_value,
+            self.source_metadata)])
 
         result_query = MetadataLedger.objects.values(
             'source_metadata_key',
@@ -56,6 +72,62 @@ class CommandIntegration(TestSetUp):
         self.assertEqual('Active', result_query.get(
             'record_lifecycle_status'))
 
+    def test_store_source_metadata_changed_and_unchanged(self):
+        """Test that a batch only inactivates and creates records whose
+        metadata changed"""
+        store_source_metadata([get_source_metadata_record(
+            self.key_value, self.key_value_hash, self.hash_value,
+            self.source_metadata)])
+
+        store_counts = store_source_metadata([
+            get_source_metadata_record(
+                self.key_value, self.key_value_hash, self.hash_value,
+                self.source_metadata),
+            get_source_metadata_record(
+                self.key_value_invalid, self.key_value_hash_invalid,
+                self.hash_value_invalid, self.metadata_invalid)])
+        self.assertEqual(store_counts['unchanged'], 1)
+        self.assertEqual(store_counts['new'], 1)
+        self.assertEqual(MetadataLedger.objects.count(), 2)
+
+        store_counts = store_source_metadata([get_source_metadata_record(
+            self.key_value, self.key_value_hash, self.hash_value_invalid,
+            self.metadata_invalid)])
+        self.assertEqual(store_counts['changed'], 1)
+        self.assertEqual(MetadataLedger.objects.filter(
+            source_metadata_key_hash=self.key_value_hash,
+            record_lifecycle_status='Inactive').count(), 1)
+        result_query = MetadataLedger.objects.get(
+            source_metadata_key_hash=self.key_value_hash,
+            record_lifecycle_status='Active')
+        self.assertEqual(self.hash_value_invalid,
+                         result_query.source_metadata_hash)
+
+    def test_inactivate_removed_source_records(self):
+        """Test that only active records removed from the source are
+        inactivated"""
+        store_source_metadata([
+            get_source_metadata_record(
+                self.key_value, self.key_value_hash, self.hash_value,
+                self.source_metadata),
+            get_source_metadata_record(
+                self.key_value_invalid, self.key_value_hash_invalid,
+                self.hash_value_invalid, self.metadata_invalid)])
+
+        inactivated_count = inactivate_removed_source_records(
+            [self.key_value_hash_invalid], batch_size=1)
+        self.assertEqual(inactivated_count, 1)
+        removed_record = MetadataLedger.objects.get(
+            source_metadata_key_hash=self.key_value_hash_invalid)
+        self.assertEqual(removed_record.record_lifecycle_status, 'Inactive')
+        self.assertIsNotNone(removed_record.metadata_record_inactivation_date)
+        self.assertEqual(MetadataLedger.objects.get(
+            source_metadata_key_hash=self.key_value_hash
+        ).record_lifecycle_status, 'Active')
+
+        self.assertEqual(inactivate_removed_source_records(
+            [self.key_value_hash_invalid]), 0)
+
     def test_extract_metadata_using_key(self):
         """Test for the keys and hash creation and save in
         Metadata_ledger table """
@@ -79,6 +151,256 @@ class CommandIntegration(TestSetUp):
         self.assertEqual(self.source_metadata, result_query.get(
             'source_metadata'))
 
+    def test_get_source_metadata_workers_shared_key(self):
+        """Test that a key found in source files extracted by several
+        workers is stored once"""
+        xiaConfig = XIAConfiguration(publisher='JKO')
+        xiaConfig.save()
+        key = get_source_metadata_key_value(
+            {'LearningResourceIdentifier': 'key1', 'SOURCESYSTEM': 'JKO'})
+        MetadataLedger(record_lifecycle_status='Active',
+                       source_metadata={'LearningResourceIdentifier': 'key1'},
+                       source_metadata_hash=self.hash_value,
+                       source_metadata_key=key['key_value'],
+                       source_metadata_key_hash=key['key_value_hash']).save()
+        source_files = [
+            ContentFile(b'LearningResourceIdentifier,Title\nkey1,first\n'
+                        b'key2,second\n', name='source_file_1.csv'),
+            ContentFile(b'LearningResourceIdentifier,Title\nkey1,third\n',
+                        name='source_file_2.csv')]
+
+        stored_counts = []
+
+        def run_in_worker_processes(function, arguments_list, workers):
+            for arguments in arguments_list:
+                # workers only read their files, records are stored after
+                # each file is returned
+                with self.assertNumQueries(0):
+                    file_chunks = pickle.loads(pickle.dumps(
+                        function(*arguments)))
+                stored_counts.append(MetadataLedger.objects.count())
+                yield file_chunks
+
+        with patch('core.management.commands.extract_source_metadata'
+                   '.get_source_files', return_value=source_files), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_format', return_value='csv'), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_fingerprint',
+                      return_value=self.source_file_fingerprint), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.store_source_file_fingerprint'), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.iterate_in_process_pool',
+                      side_effect=run_in_worker_processes) as mock_pool:
+            extraction_counts = get_source_metadata(force=True, workers=2)
+
+        self.assertEqual(mock_pool.call_count, 1)
+        # the first file was stored before the second file was returned
+        self.assertEqual(stored_counts, [1, 3])
+        self.assertEqual(extraction_counts['removed'], 0)
+        active_records = MetadataLedger.objects.filter(
+            source_metadata_key_hash=key['key_value_hash'],
+            record_lifecycle_status='Active')
+        self.assertEqual(active_records.count(), 1)
+        self.assertEqual(active_records.get().source_metadata['Title'],
+                         'third')
+        self.assertEqual(MetadataLedger.objects.filter(
+            record_lifecycle_status='Active').count(), 2)
+
+    def test_get_source_metadata_removed_source_file(self):
+        """Test that records of a source file removed from the configuration
+        are inactivated although the remaining files are unchanged"""
+        xiaConfig = XIAConfiguration(publisher='JKO')
+        xiaConfig.save()
+
+        def get_source_files(*file_numbers):
+            return [ContentFile(
+                b'LearningResourceIdentifier,Title\nkey%d,title\n' % number,
+                name='source_file_%d.csv' % number)
+                for number in file_numbers]
+
+        def get_fingerprint(source_file):
+            return {'source_file_name': source_file.name,
+                    'source_file_size': source_file.size,
+                    'source_file_modified': None,
+                    'source_file_etag': 'etag_' + source_file.name}
+
+        with patch('core.management.commands.extract_source_metadata'
+                   '.get_source_files') as mock_source_files, \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_format', return_value='csv'), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_fingerprint',
+                      side_effect=get_fingerprint), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_digest', return_value='digest'):
+            mock_source_files.return_value = get_source_files(1, 2)
+            get_source_metadata()
+            mock_source_files.return_value = get_source_files(1)
+            extraction_counts = get_source_metadata()
+
+        self.assertEqual(extraction_counts['removed'], 1)
+        self.assertEqual(MetadataLedger.objects.filter(
+            record_lifecycle_status='Active').count(), 1)
+
+    def test_extract_metadata_using_key_active_key_index(self):
+        """Test that records matching the active key index are not stored
+        again"""
+        input_data = pd.DataFrame.from_dict([self.source_metadata])
+        xiaConfig = XIAConfiguration(publisher='JKO')
+        xiaConfig.save()
+        active_key_index = get_active_source_key_index()
+        seen_key_hashes = set()
+        extraction_counts = extract_metadata_using_key(input_data,
+                                                       active_key_index,
+                                                       None, seen_key_hashes)
+        self.assertEqual(extraction_counts['new'], 1)
+        self.assertEqual(seen_key_hashes, {self.key_value_hash})
+        self.assertEqual(active_key_index,
+                         {self.key_value_hash: self.hash_value})
+
+        with patch('core.management.commands.extract_source_metadata'
+                   '.store_source_metadata') as mock_store_source:
+            extraction_counts = extract_metadata_using_key(
+                input_data, get_active_source_key_index())
+            mock_store_source.assert_called_once_with([])
+        self.assertEqual(extraction_counts['unchanged'], 1)
+
+    def test_is_source_file_unchanged(self):
+        """Test comparing the source file against the stored fingerprint"""
+        fingerprint = dict(self.source_file_fingerprint,
+                           extraction_settings_hash=self.hash_value)
+        with patch('core.management.commands.extract_source_metadata'
+                   '.get_source_file_digest',
+                   return_value=self.key_value_hash) as mock_digest:
+            self.assertFalse(is_source_file_unchanged(None, fingerprint))
+            store_source_file_fingerprint(None, fingerprint)
+            self.assertEqual(mock_digest.call_count, 1)
+
+            # same modified time does not need the content digest
+            self.assertTrue(is_source_file_unchanged(
+                None, dict(fingerprint)))
+            self.assertEqual(mock_digest.call_count, 1)
+
+            # touched file with the same content is still unchanged
+            touched_fingerprint = dict(fingerprint,
+                                       source_file_modified=timezone.now())
+            self.assertTrue(is_source_file_unchanged(
+                None, touched_fingerprint))
+            self.assertEqual(mock_digest.call_count, 2)
+
+            mock_digest.return_value = self.hash_value
+            self.assertFalse(is_source_file_unchanged(
+                None, dict(fingerprint, source_file_modified=None)))
+            self.assertFalse(is_source_file_unchanged(
+                None, dict(fingerprint, extraction_settings_hash='')))
+
+    # Test cases for rehash_metadata_ledger
+
+    def test_rehash_metadata_ledger(self):
+        """Test that ledger hashes are recalculated with the current
+        hashing scheme"""
+        MetadataLedger(
+            record_lifecycle_status='Active',
+            source_metadata=self.source_metadata,
+            source_metadata_hash='old_source_hash',
+            source_metadata_key=self.key_value,
+            source_metadata_key_hash=self.key_value_hash,
+            target_metadata=self.target_metadata,
+            target_metadata_hash='old_target_hash',
+            target_metadata_key=self.target_key_value,
+            target_metadata_key_hash=self.target_key_value_hash).save()
+        SupplementalLedger(
+            record_lifecycle_status='Active',
+            supplemental_metadata=self.supplemental_data,
+            supplemental_metadata_hash='old_target_hash',
+            supplemental_metadata_key=self.target_key_value,
+            supplemental_metadata_key_hash=self.target_key_value_hash).save()
+
+        self.assertEqual(rehash_metadata_ledger(), 1)
+        self.assertEqual(rehash_metadata_ledger(), 0)
+
+        result_query = MetadataLedger.objects.get(
+            source_metadata_key_hash=self.key_value_hash)
+        self.assertEqual(self.hash_value, result_query.source_metadata_hash)
+        self.assertEqual(get_metadata_hash(self.target_metadata),
+                         result_query.target_metadata_hash)
+        self.assertEqual(get_metadata_hash(self.supplemental_data),
+                         SupplementalLedger.objects.get().
+                         supplemental_metadata_hash)
+
+    def test_rehash_metadata_ledger_supplemental_conflict(self):
+        """Test that only the latest transformed supplemental record is kept
+        when records with the same key are rehashed to the same hash"""
+        hash_value = get_metadata_hash(self.supplemental_data)
+        earlier_date = timezone.now() - timezone.timedelta(days=1)
+        later_date = timezone.now()
+        latest_records = {}
+        for key_value, old_hash_date, hash_date in [
+                ('key1', later_date, earlier_date),
+                ('key2', earlier_date, later_date)]:
+            for record_hash, transformation_date in [
+                    ('old_target_hash', old_hash_date),
+                    (hash_value, hash_date)]:
+                supplemental_record = SupplementalLedger(
+                    record_lifecycle_status='Active',
+                    supplemental_metadata=self.supplemental_data,
+                    supplemental_metadata_hash=record_hash,
+                    supplemental_metadata_key=key_value,
+                    supplemental_metadata_key_hash=key_value,
+                    supplemental_metadata_transformation_date=(
+                        transformation_date))
+                supplemental_record.save()
+                if transformation_date == later_date:
+                    latest_records[key_value] = \
+                        supplemental_record.metadata_record_uuid
+
+        self.assertEqual(rehash_metadata_ledger(batch_size=1), 0)
+
+        self.assertEqual(list(SupplementalLedger.objects.order_by(
+            'supplemental_metadata_key_hash').values_list(
+            'supplemental_metadata_key_hash', 'metadata_record_uuid',
+            'supplemental_metadata_hash')),
+            [('key1', latest_records['key1'], hash_value),
+             ('key2', latest_records['key2'], hash_value)])
+
+    def test_iterate_ledger(self):
+        """Test streaming ledger records in pages of primary keys"""
+        for key_value in ['key1', 'key2', 'key3']:
+            MetadataLedger(record_lifecycle_status='Active',
+                           source_metadata_key=key_value,
+                           source_metadata=self.source_metadata).save()
+
+        records = list(iterate_ledger(MetadataLedger.objects.values(
+            'source_metadata_key'), page_size=2))
+        self.assertEqual(sorted(record['source_metadata_key']
+                                for record in records),
+                         ['key1', 'key2', 'key3'])
+        self.assertEqual(set(records[0]), {'source_metadata_key'})
+
+        records = list(iterate_ledger(MetadataLedger.objects.filter(
+            source_metadata_key__in=['key1', 'key3']), page_size=1))
+        self.assertEqual(sorted(record.source_metadata_key
+                                for record in records), ['key1', 'key3'])
+
+        self.assertEqual(list(iterate_ledger([{'key': 'value'}])),
+                         [{'key': 'value'}])
+
+    def test_get_ledger_pk_ranges(self):
+        """Test splitting ledger records into ranges of primary keys"""
+        for key_value in ['key1', 'key2', 'key3']:
+            MetadataLedger(record_lifecycle_status='Active',
+                           source_metadata_key=key_value,
+                           source_metadata=self.source_metadata).save()
+        pks = sorted(MetadataLedger.objects.values_list('pk', flat=True))
+
+        self.assertEqual(get_ledger_pk_ranges(MetadataLedger.objects.all(),
+                                              2),
+                         [(pks[0], pks[1]), (pks[2], pks[2])])
+        self.assertEqual(get_ledger_pk_ranges(
+            MetadataLedger.objects.none(), 2), [])
+
     # # Test cases for validate_source_metadata
 
     def test_get_source_validation_schema(self):
@@ -102,9 +424,71 @@ class CommandIntegration(TestSetUp):
             source_metadata_key_hash=self.key_value_hash,
             source_metadata_extraction_date=timezone.now())
         metadata_ledger.save()
-        test_source_data = get_source_metadata_for_validation()
+        test_source_data = get_source_metadata_for_validation(
+            self.schema_version)
         self.assertTrue(test_source_data)
 
+    def test_validate_source_in_process_pool(self):
+        """Test validating chunks of source records in worker processes and
+        merging their reports"""
+        for key_value in ['key1', 'key2', 'key3']:
+            source_metadata = dict(self.source_metadata,
+                                   LearningResourceIdentifier=key_value)
+            key = get_source_metadata_key_value(source_metadata)
+            MetadataLedger(record_lifecycle_status='Active',
+                           source_metadata=source_metadata,
+                           source_metadata_hash=key_value,
+                           source_metadata_key=key['key_value'],
+                           source_metadata_key_hash=key['key_value_hash'],
+                           source_metadata_extraction_date=timezone.now()
+                           ).save()
+        compiled_schema = CompiledSchema(self.test_required_column_names,
+                                         version=self.schema_version)
+
+        with patch('core.management.commands.validate_source_metadata'
+                   '.VALIDATION_CHUNK_SIZE', 2), \
+                patch('core.management.commands.validate_source_metadata'
+                      '.run_in_process_pool',
+                      side_effect=lambda function, arguments_list, workers: [
+                          function(*arguments)
+                          for arguments in arguments_list]) as mock_pool:
+            report = validate_source_in_process_pool(
+                get_source_metadata_for_validation(self.schema_version),
+                compiled_schema, 2, 500)
+
+        self.assertEqual(len(mock_pool.call_args[0][1]), 2)
+        self.assertEqual(report.record_count, 3)
+        self.assertEqual(MetadataLedger.objects.filter(
+            source_metadata_validation_status='Y').count(), 3)
+
+    def test_validate_source_using_key_unchanged(self):
+        """Test that records validated with the same record hash and schema
+        version are skipped and validated again when the schema changes"""
+        metadata_ledger = MetadataLedger(
+            record_lifecycle_status='Active',
+            source_metadata=self.source_metadata,
+            source_metadata_hash=self.hash_value,
+            source_metadata_key=self.key_value,
+            source_metadata_key_hash=self.key_value_hash,
+            source_metadata_extraction_date=timezone.now())
+        metadata_ledger.save()
+        compiled_schema = CompiledSchema(self.test_required_column_names,
+                                         version=self.schema_version)
+        validate_source_using_key(
+            get_source_metadata_for_validation(self.schema_version),
+            compiled_schema)
+        # upstream stages reset the validation status of unchanged records
+        MetadataLedger.objects.update(source_metadata_validation_status='')
+
+        self.assertEqual(1, restore_source_metadata_validation_status(
+            self.schema_version))
+        self.assertEqual('Y', MetadataLedger.objects.values_list(
+            'source_metadata_validation_status', flat=True).first())
+        self.assertFalse(get_source_metadata_for_validation(
+            self.schema_version).exists())
+        self.assertTrue(get_source_metadata_for_validation(
+            'changed schema version').exists())
+
     def test_validate_source_using_key(self):
         """Test to check validation process for source"""
 
@@ -127,9 +511,8 @@ class CommandIntegration(TestSetUp):
         metadata_ledger_invalid.save()
         result_test_query = MetadataLedger.objects. \
             values('source_metadata')
-        validate_source_using_key(result_test_query,
-                                  self.test_required_column_names,
-                                  recommended_column_name)
+        validate_source_using_key(result_test_query, CompiledSchema(
+            self.test_required_column_names, recommended_column_name))
         result_query = MetadataLedger.objects. \
             values('source_metadata_validation_status',
                    'record_lifecycle_status'). \
@@ -219,6 +602,213 @@ class CommandIntegration(TestSetUp):
         self.assertTrue(result_data_supplemental.
                         get('supplemental_metadata_hash'))
 
+    def test_transform_source_using_key_numbers(self):
+        """Test that integers and floats of a chunk of records are stored as
+        they are in target and supplemental metadata"""
+        source_records = [
+            dict(self.source_metadata, test_length=1, Test=1),
+            {'Test': 2.5, 'test_length': 2.5, 'Test_id': 7,
+             'LearningResourceIdentifier': 'TestData 456',
+             'SOURCESYSTEM': 'JKO', 'test_name': {'nested': 3}}]
+        for source_metadata in source_records:
+            key = get_source_metadata_key_value(source_metadata)
+            MetadataLedger(
+                record_lifecycle_status='Active',
+                source_metadata=source_metadata,
+                source_metadata_hash=self.hash_value,
+                source_metadata_validation_status='Y',
+                source_metadata_key=key['key_value'],
+                source_metadata_key_hash=key['key_value_hash'],
+                source_metadata_validation_date=timezone.now()).save()
+        test_data_dict = MetadataLedger.objects.values(
+            'source_metadata').filter(
+            source_metadata_validation_status='Y',
+            record_lifecycle_status='Active')
+
+        transform_source_using_key(test_data_dict,
+                                   self.source_target_mapping,
+                                   self.test_required_column_names)
+        # values are compared as json to tell 1 from 1.0
+        stored_metadata = json.dumps([
+            list(MetadataLedger.objects.order_by(
+                'target_metadata_key').values_list(
+                'target_metadata_key', 'target_metadata')),
+            list(SupplementalLedger.objects.order_by(
+                'supplemental_metadata_key').values_list(
+                'supplemental_metadata_key', 'supplemental_metadata'))])
+
+        self.assertIn('"EstimatedCompletionTime": 1,', stored_metadata)
+        self.assertIn('{"Test": 2.5, "Test_id": 7', stored_metadata)
+
+    def test_transform_source_using_key_stored_once(self):
+        """Test that transforming a record again keeps one supplemental
+        record per key and metadata hash"""
+        metadata_ledger = MetadataLedger(
+            record_lifecycle_status='Active',
+            source_metadata=self.source_metadata,
+            source_metadata_hash=self.key_value_hash,
+            source_metadata_validation_status='Y',
+            source_metadata_key=self.key_value,
+            source_metadata_validation_date=timezone.now())
+        metadata_ledger.save()
+        test_data_dict = MetadataLedger.objects.values(
+            'source_metadata').filter(
+            source_metadata_validation_status='Y',
+            record_lifecycle_status='Active')
+
+        for _ in range(2):
+            transform_source_using_key(test_data_dict,
+                                       self.source_target_mapping,
+                                       self.test_required_column_names)
+
+        result_data = MetadataLedger.objects.get(
+            source_metadata_key=self.key_value)
+        self.assertEqual(result_data.source_metadata_transformation_hash,
+                         self.key_value_hash)
+        self.assertEqual(
+            result_data.target_metadata_hash,
+            get_metadata_hash(result_data.target_metadata))
+        self.assertEqual(SupplementalLedger.objects.filter(
+            supplemental_metadata_key=self.key_value).count(), 1)
+
+    def test_transform_source_using_key_supplemental_changed(self):
+        """Test that supplemental metadata is stored again when only fields
+        which are not mapped changed"""
+        metadata_ledger = MetadataLedger(
+            record_lifecycle_status='Active',
+            source_metadata=self.source_metadata,
+            source_metadata_hash=self.key_value_hash,
+            source_metadata_validation_status='Y',
+            source_metadata_key=self.key_value,
+            source_metadata_validation_date=timezone.now())
+        metadata_ledger.save()
+        test_data_dict = MetadataLedger.objects.values(
+            'source_metadata').filter(
+            source_metadata_validation_status='Y',
+            record_lifecycle_status='Active')
+
+        transform_source_using_key(test_data_dict,
+                                   self.source_target_mapping,
+                                   self.test_required_column_names)
+        MetadataLedger.objects.filter(
+            source_metadata_key=self.key_value).update(
+            source_metadata=dict(self.source_metadata,
+                                 unmapped_field='changed'))
+        store_counts = transform_source_using_key(
+            test_data_dict, self.source_target_mapping,
+            self.test_required_column_names)
+
+        self.assertEqual(store_counts['unchanged'], 1)
+        supplemental_metadata = [
+            record.supplemental_metadata for record in
+            SupplementalLedger.objects.filter(
+                supplemental_metadata_key=self.key_value)]
+        self.assertEqual(len(supplemental_metadata), 2)
+        self.assertIn('changed', [
+            metadata.get('unmapped_field')
+            for metadata in supplemental_metadata])
+
+    def test_transform_source_using_key_target_unchanged(self):
+        """Test that transforming a record into unchanged target metadata
+        keeps its validation and transmission state"""
+        metadata_ledger = MetadataLedger(
+            record_lifecycle_status='Active',
+            source_metadata=self.source_metadata,
+            source_metadata_hash=self.key_value_hash,
+            source_metadata_validation_status='Y',
+            source_metadata_key=self.key_value,
+            source_metadata_validation_date=timezone.now())
+        metadata_ledger.save()
+        test_data_dict = MetadataLedger.objects.values(
+            'source_metadata').filter(
+            source_metadata_validation_status='Y',
+            record_lifecycle_status='Active')
+
+        store_counts = transform_source_using_key(
+            test_data_dict, self.source_target_mapping,
+            self.test_required_column_names)
+        self.assertEqual(store_counts['changed'], 1)
+
+        MetadataLedger.objects.filter(
+            source_metadata_key=self.key_value).update(
+            target_metadata_validation_status='Y',
+            target_metadata_transmission_status='Successful',
+            target_metadata_transmission_status_code=201)
+        store_counts = transform_source_using_key(
+            test_data_dict, self.source_target_mapping,
+            self.test_required_column_names)
+
+        result_data = MetadataLedger.objects.get(
+            source_metadata_key=self.key_value)
+        self.assertEqual(store_counts['changed'], 0)
+        self.assertEqual(store_counts['unchanged'], 1)
+        self.assertEqual(result_data.target_metadata_validation_status, 'Y')
+        self.assertEqual(result_data.target_metadata_transmission_status,
+                         'Successful')
+        self.assertEqual(
+            result_data.target_metadata_transmission_status_code, 201)
+
+    def test_transform_source_using_key_target_changed(self):
+        """Test that transforming a record into changed target metadata
+        resets its validation and transmission state"""
+        metadata_ledger = MetadataLedger(
+            record_lifecycle_status='Active',
+            source_metadata=self.source_metadata,
+            source_metadata_hash=self.key_value_hash,
+            source_metadata_validation_status='Y',
+            source_metadata_key=self.key_value,
+            source_metadata_validation_date=timezone.now(),
+            target_metadata_hash=self.hash_value,
+            target_metadata_validation_status='Y',
+            target_metadata_transmission_status='Failed',
+            target_metadata_transmission_status_code=400)
+        metadata_ledger.save()
+        test_data_dict = MetadataLedger.objects.values(
+            'source_metadata').filter(
+            source_metadata_validation_status='Y',
+            record_lifecycle_status='Active')
+
+        store_counts = transform_source_using_key(
+            test_data_dict, self.source_target_mapping,
+            self.test_required_column_names)
+
+        result_data = MetadataLedger.objects.get(
+            source_metadata_key=self.key_value)
+        self.assertEqual(store_counts['changed'], 1)
+        self.assertEqual(result_data.target_metadata_validation_status, '')
+        self.assertEqual(result_data.target_metadata_transmission_status,
+                         'Ready')
+        self.assertIsNone(
+            result_data.target_metadata_transmission_status_code)
+
+    def test_get_source_metadata_for_transformation_unchanged(self):
+        """Test that transformed records are only retrieved again when their
+        source hash or the target mapping changed"""
+        metadata_ledger = MetadataLedger(
+            record_lifecycle_status='Active',
+            source_metadata=self.source_metadata,
+            source_metadata_hash=self.key_value_hash,
+            source_metadata_validation_status='Y',
+            source_metadata_key=self.key_value,
+            source_metadata_validation_date=timezone.now())
+        metadata_ledger.save()
+        compiled_mapping = compile_mapping(self.source_target_mapping)
+
+        transform_source_using_key(
+            get_source_metadata_for_transformation(compiled_mapping.version),
+            compiled_mapping, self.test_required_column_names)
+
+        self.assertFalse(get_source_metadata_for_transformation(
+            compiled_mapping.version).exists())
+        self.assertTrue(get_source_metadata_for_transformation(
+            self.schema_version).exists())
+
+        MetadataLedger.objects.filter(
+            source_metadata_key=self.key_value).update(
+            source_metadata_hash=self.schema_version)
+        self.assertTrue(get_source_metadata_for_transformation(
+            compiled_mapping.version).exists())
+
     # Test cases for validate_target_metadata
 
     def test_get_target_validation_schema(self):
@@ -268,7 +858,8 @@ class CommandIntegration(TestSetUp):
                          'General_Information.EndDate'}
         recommended_dict = {'CourseInstance.Thumbnail',
                             'Technical_Information.Thumbnail'}
-        validate_target_using_key(test_data, required_dict, recommended_dict)
+        validate_target_using_key(test_data, CompiledSchema(
+            required_dict, recommended_dict))
         result_query = MetadataLedger.objects.values(
             'target_metadata_validation_status', 'record_lifecycle_status'). \
             filter(target_metadata_key_hash=self.target_key_value_hash).first()
@@ -1,18 +1,23 @@
+import json
 import logging
+from collections import Counter
+from datetime import datetime
 from unittest.mock import patch
 
 import pandas as pd
-from ddt import ddt
+from ddt import data, ddt, unpack
+from django.core.files import File
 from django.core.management import call_command
 from django.db.utils import OperationalError
 from django.test import tag
-from django.utils import timezone
 
 from core.management.commands.conformance_alerts import send_log_email
 from core.management.commands.extract_source_metadata import (
-    add_publisher_to_source, extract_metadata_using_key,
-    get_metadata_fields_to_overwrite, get_source_metadata,
-    overwrite_append_metadata, overwrite_metadata_field)
+    add_publisher_to_source, drop_duplicate_source_rows,
+    extract_metadata_using_key, get_metadata_fields_to_overwrite,
+    get_source_columns_to_extract, get_source_metadata,
+    normalize_source_metadata, overwrite_append_metadata,
+    overwrite_metadata_field)
 from core.management.commands.load_supplemental_metadata import (
     load_supplemental_metadata_to_xis, post_supplemental_metadata_to_xis,
     rename_supplemental_metadata_fields)
@@ -26,10 +31,10 @@ from core.management.commands.validate_source_metadata import (
     get_source_metadata_for_validation, validate_source_using_key)
 from core.management.commands.validate_target_metadata import (
     get_target_metadata_for_validation, validate_target_using_key)
+from core.management.utils.xia_internal import CompiledSchema
 from core.models import (MetadataFieldOverwrite, MetadataLedger,
                          ReceiverEmailConfiguration, SenderEmailConfiguration,
-                         SupplementalLedger, XIAConfiguration,
-                         XISConfiguration)
+                         XIAConfiguration, XISConfiguration)
 
 from .test_setup import TestSetUp
 
@@ -62,15 +67,136 @@ class CommandTests(TestSetUp):
     def test_get_source_metadata(self):
         """ Test to retrieving source metadata"""
         with patch('core.management.commands.extract_source_metadata'
-                   '.read_source_file') as read_obj, patch(
+                   '.read_source_file_in_chunks') as read_obj, patch(
             'core.management.commands.extract_source_metadata'
             '.extract_metadata_using_key', return_value=None) as \
-                mock_extract_obj:
+                mock_extract_obj, \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_files',
+                      return_value=[File(None, 'jko_source_file.xlsx')]), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_format', return_value='xlsx'), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_fingerprint',
+                      return_value=self.source_file_fingerprint), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_extraction_settings_hash',
+                      return_value=self.hash_value), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.store_source_file_fingerprint') as mock_store_fp:
             read_obj.return_value = read_obj
-            read_obj.return_value = [
-                pd.DataFrame.from_dict(self.test_data, orient='index')]
+            read_obj.return_value = iter([
+                pd.DataFrame.from_dict(self.test_data, orient='index'),
+                pd.DataFrame.from_dict(self.test_data1, orient='index')])
             get_source_metadata()
-            self.assertEqual(mock_extract_obj.call_count, 1)
+            self.assertEqual(mock_extract_obj.call_count, 2)
+            self.assertEqual(mock_store_fp.call_count, 1)
+
+    @data((False, 0), (True, 1))
+    @unpack
+    def test_get_source_metadata_unchanged_file(self, force, read_count):
+        """Test that an unchanged source file is only extracted when
+        forced"""
+        with patch('core.management.commands.extract_source_metadata'
+                   '.read_source_file_in_chunks',
+                   return_value=iter([])) as read_obj, \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_files',
+                      return_value=[File(None, 'jko_source_file.xlsx')]), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_format', return_value='xlsx'), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_fingerprint',
+                      return_value=self.source_file_fingerprint), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_extraction_settings_hash',
+                      return_value=self.hash_value), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.is_source_file_unchanged', return_value=True), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.store_source_file_fingerprint'):
+            get_source_metadata(force=force)
+            self.assertEqual(read_obj.call_count, read_count)
+
+    @data((1, 0), (2, 1))
+    @unpack
+    def test_get_source_metadata_source_files(self, workers, pool_count):
+        """Test that chunks of several source files, read in a process pool
+        or one file at a time, are stored in this process"""
+        source_files = [File(None, 'jko_source_file_1.xlsx'),
+                        File(None, 'jko_source_file_2.xlsx')]
+        file_chunks = [['chunk1'], ['chunk2', 'chunk3']]
+        chunk_results = {'chunk1': (Counter(new=1), {'key1'}),
+                         'chunk2': (Counter(new=1), {'key2'}),
+                         'chunk3': (Counter(unchanged=1), {'key3'})}
+
+        def extract_chunk(source_chunk, active_key_index, overwrite_plan,
+                          seen_key_hashes, duplicate_policy,
+                          seen_key_values):
+            chunk_counts, chunk_key_hashes = chunk_results[source_chunk]
+            seen_key_hashes.update(chunk_key_hashes)
+            return chunk_counts
+
+        with patch('core.management.commands.extract_source_metadata'
+                   '.get_source_files', return_value=source_files), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_format', return_value='xlsx'), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_source_file_fingerprint',
+                      return_value=self.source_file_fingerprint), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_extraction_settings_hash',
+                      return_value=self.hash_value), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_active_source_key_index',
+                      return_value={'key1': 'hash1', 'key4': 'hash4'}), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_metadata_fields_to_overwrite',
+                      return_value=[]), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.read_normalized_source_chunks',
+                      side_effect=file_chunks) as mock_read_file, \
+                patch('core.management.commands.extract_source_metadata'
+                      '.iterate_in_process_pool',
+                      return_value=file_chunks) as mock_pool, \
+                patch('core.management.commands.extract_source_metadata'
+                      '.extract_metadata_using_key',
+                      side_effect=extract_chunk) as mock_extract, \
+                patch('core.management.commands.extract_source_metadata'
+                      '.inactivate_removed_source_records',
+                      return_value=1) as mock_inactivate, \
+                patch('core.management.commands.extract_source_metadata'
+                      '.store_source_file_fingerprint') as mock_store_fp:
+            extraction_counts = get_source_metadata(workers=workers)
+
+            self.assertEqual(mock_pool.call_count, pool_count)
+            self.assertEqual(mock_read_file.call_count,
+                             2 * (1 - pool_count))
+            self.assertEqual(mock_extract.call_count, 3)
+            mock_inactivate.assert_called_once_with({'key4'})
+            self.assertEqual(mock_store_fp.call_count, 2)
+        self.assertEqual(extraction_counts,
+                         Counter(new=2, unchanged=1, removed=1))
+
+    def test_get_source_columns_to_extract(self):
+        """Test retrieving source columns used by validation and
+        transformation"""
+        with patch('core.management.commands.extract_source_metadata'
+                   '.get_source_validation_schema',
+                   return_value=self.schema_data_dict), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.get_target_metadata_for_transformation',
+                      return_value=self.source_target_mapping), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.MetadataFieldOverwrite.objects') as mock_field:
+            mock_field.values_list.return_value = ['column1']
+            source_columns = get_source_columns_to_extract()
+
+        self.assertTrue({'LearningResourceIdentifier', 'SOURCESYSTEM',
+                         'test_url', 'Test_current', 'test_postscript',
+                         'start_date', 'column1'} <= source_columns)
+        self.assertNotIn('', source_columns)
+        self.assertNotIn('supplemental_data', source_columns)
 
     def test_add_publisher_to_source(self):
         """Test for Add publisher column to source metadata and return
@@ -120,36 +246,123 @@ class CommandTests(TestSetUp):
 
         with patch('core.management.commands.extract_source_metadata'
                    '.get_metadata_fields_to_overwrite') as mock_get_overwrite:
-            mock_get_overwrite.return_value = self.metadata_df
+            mock_get_overwrite.return_value = [('test_name', 'value1', True),
+                                               ('column2', 2, False)]
 
-            return_val = overwrite_metadata_field(self.metadata_df)
+            return_val = overwrite_metadata_field(self.metadata_df.copy())
             self.assertIsInstance(return_val, dict)
+            self.assertEqual(return_val[1]['test_name'], 'value1')
+            self.assertEqual(return_val[1]['column2'], 2)
+
+            return_val = overwrite_metadata_field(self.metadata_df.copy(),
+                                                  [])
+            self.assertEqual(return_val[1]['test_name'], 'test name')
+            self.assertEqual(mock_get_overwrite.call_count, 1)
+
+    def test_overwrite_metadata_field_normalized_columns(self):
+        """Test that only overwritten columns of a normalized chunk are
+        normalized again"""
+        with patch('core.management.commands.extract_source_metadata'
+                   '.normalize_source_metadata',
+                   wraps=normalize_source_metadata) as mock_normalize:
+            return_val = overwrite_metadata_field(
+                self.metadata_df.copy(),
+                [('column2', datetime(2021, 1, 2), False)])
+
+            self.assertEqual(mock_normalize.call_count, 1)
+            self.assertEqual(list(mock_normalize.call_args[0][0].columns),
+                             ['column2'])
+            self.assertEqual(return_val[1]['column2'], '2021-01-02T00:00:00')
+            self.assertEqual(return_val[1]['test_name'], 'test name')
 
     def test_get_metadata_fields_to_overwrite(self):
-        """Test for looping through fields to be overwrite or appended"""
+        """Test for compiling fields to be overwrite or appended"""
         with patch('core.management.commands.extract_source_metadata'
-                   '.MetadataFieldOverwrite.objects') as mock_field, \
-                patch('core.management.commands.extract_source_metadata'
-                      '.overwrite_append_metadata') as mock_overwrite_fun:
+                   '.MetadataFieldOverwrite.objects') as mock_field:
             config = \
                 [MetadataFieldOverwrite(field_name='column1', overwrite=True,
-                                        field_value='value1'),
+                                        field_type='int', field_value='1'),
                  MetadataFieldOverwrite(field_name='column2', overwrite=False,
+                                        field_type='char',
                                         field_value='value2')]
             mock_field.all.return_value = config
-            mock_overwrite_fun.return_value = self.metadata_df
 
-            return_val = get_metadata_fields_to_overwrite(self.metadata_df)
-            print(return_val)
-            self.assertEqual(mock_overwrite_fun.call_count, 2)
+            return_val = get_metadata_fields_to_overwrite()
+            self.assertEqual(return_val, [('column1', 1, True),
+                                          ('column2', 'value2', False)])
 
-    def test_overwrite_append_metadata(self):
+    @data((True, ['value1', 'value1']), (False, ['test', 'value1']))
+    @unpack
+    def test_overwrite_append_metadata(self, overwrite_flag, expected_value):
         """test Overwrite & append metadata fields based on overwrite flag """
+        metadata_df = pd.DataFrame({'column1': ['test', None]})
+        metadata_df['column1'] = \
+            overwrite_append_metadata(metadata_df, 'column1', 'value1',
+                                      overwrite_flag)
+
+        self.assertEqual(metadata_df['column1'].tolist(), expected_value)
+
+    def test_overwrite_append_metadata_new_column(self):
+        """test appending metadata field missing in source"""
         return_val = \
             overwrite_append_metadata(self.metadata_df, 'column1', 'value1',
-                                      True)
-
-        self.assertEqual(return_val['column1'].all(), 'value1')
+                                      False)
+
+        self.assertEqual(return_val, 'value1')
+
+    @data(('first', ['a', 'b', None], ['1', '2', '4']),
+          ('last', ['b', 'a', None], ['2', '3', '4']))
+    @unpack
+    def test_drop_duplicate_source_rows(self, duplicate_policy,
+                                        expected_keys, expected_rows):
+        """test keeping one source row per key under the duplicate policy"""
+        source_df = pd.DataFrame({
+            'LearningResourceIdentifier': ['a', 'b', 'a', None],
+            'SOURCESYSTEM': ['JKO'] * 4,
+            'row': ['1', '2', '3', '4']})
+        seen_key_values = set()
+
+        return_df, duplicate_key_values = drop_duplicate_source_rows(
+            source_df, duplicate_policy, seen_key_values)
+        self.assertEqual(return_df['LearningResourceIdentifier'].tolist(),
+                         expected_keys)
+        self.assertEqual(return_df['row'].tolist(), expected_rows)
+        self.assertEqual(duplicate_key_values, ['a_JKO'])
+        self.assertEqual(seen_key_values, {'a_JKO', 'b_JKO'})
+
+    @data(('first', 0), ('last', 1))
+    @unpack
+    def test_drop_duplicate_source_rows_earlier_chunk(self,
+                                                      duplicate_policy,
+                                                      expected_count):
+        """test handling of rows with keys found in earlier chunks"""
+        source_df = pd.DataFrame({'LearningResourceIdentifier': ['a'],
+                                  'SOURCESYSTEM': ['JKO']})
+
+        return_df, duplicate_key_values = drop_duplicate_source_rows(
+            source_df, duplicate_policy, {'a_JKO'})
+        self.assertEqual(len(return_df), expected_count)
+        self.assertEqual(duplicate_key_values, ['a_JKO'])
+
+    def test_normalize_source_metadata(self):
+        """test converting dates and null values of source metadata to JSON
+        compatible values"""
+        metadata_df = pd.DataFrame({
+            'date': pd.to_datetime(['2021-01-02 03:04:05',
+                                    '2021-01-02 03:04:05.5', None]),
+            'mixed': [datetime(2021, 1, 2), 'text', None],
+            'number': [1.5, float('nan'), 2.0]})
+
+        return_val = normalize_source_metadata(metadata_df).to_dict(
+            orient='records')
+
+        self.assertEqual(return_val, [
+            {'date': '2021-01-02T03:04:05', 'mixed': '2021-01-02T00:00:00',
+             'number': 1.5},
+            {'date': '2021-01-02T03:04:05.500000', 'mixed': 'text',
+             'number': None},
+            {'date': None, 'mixed': None, 'number': 2.0}])
+        self.assertEqual(json.loads(json.dumps(return_val)), return_val)
 
     # Test cases for validate_source_metadata
 
@@ -164,13 +377,18 @@ class CommandTests(TestSetUp):
                 record_lifecycle_status='Active').exclude(
                 source_metadata_extraction_date=None)
             meta_obj.first.return_value = meta_ledger
-            return_from_function = get_source_metadata_for_validation()
+            return_from_function = get_source_metadata_for_validation(
+                self.schema_version)
             self.assertEqual(meta_obj.first.return_value,
                              return_from_function)
 
-    def test_validate_source_using_key_more_than_one(self):
+    @data((500, 1), (1, 2))
+    @unpack
+    def test_validate_source_using_key_more_than_one(self, batch_size,
+                                                     store_count):
         """Test to Validating source data against required & recommended
-        column names for more than one row"""
+        column names for more than one row, storing results with the same
+        outcome together"""
         data = [{1: self.source_metadata}, {2: self.source_metadata}]
 
         recommended_column_name = []
@@ -185,10 +403,11 @@ class CommandTests(TestSetUp):
             mock_get_source_kv.filter.side_effect = [
                 mock_get_source_kv, mock_get_source_kv]
 
-            validate_source_using_key(data, self.test_required_column_names,
-                                      recommended_column_name)
+            validate_source_using_key(data, CompiledSchema(
+                self.test_required_column_names, recommended_column_name),
+                batch_size)
             self.assertEqual(
-                mock_store_source_valid_status.call_count, 2)
+                mock_store_source_valid_status.call_count, store_count)
 
     def test_validate_source_using_key_more_than_zero(self):
         """Test to Validating source data against required/ recommended column
@@ -206,8 +425,8 @@ class CommandTests(TestSetUp):
             mock_get_source_kv.filter.side_effect = [
                 mock_get_source_kv, mock_get_source_kv]
 
-            validate_source_using_key(data, self.test_required_column_names,
-                                      recommended_column_name)
+            validate_source_using_key(data, CompiledSchema(
+                self.test_required_column_names, recommended_column_name))
             self.assertEqual(
                 mock_store_source_valid_status.call_count, 0)
 
@@ -224,7 +443,8 @@ class CommandTests(TestSetUp):
                 record_lifecycle_status='Active').exclude(
                 source_metadata_validation_date=None)
             meta_obj.first.return_value = target_data_dict
-            return_from_function = get_source_metadata_for_transformation()
+            return_from_function = get_source_metadata_for_transformation(
+                self.schema_version)
             self.assertEqual(meta_obj.first.return_value,
                              return_from_function)
 
@@ -300,7 +520,30 @@ class CommandTests(TestSetUp):
                                        self.test_required_column_names)
 
             self.assertEqual(
-                mock_store_transformed_source.call_count, 2)
+                mock_store_transformed_source.call_count, 1)
+            self.assertEqual(
+                len(mock_store_transformed_source.call_args[0][0]), 2)
+
+    @data((500, 1), (2, 2))
+    @unpack
+    def test_transform_source_using_key_chunks(self, chunk_size,
+                                               chunk_count):
+        """Test for storing transformed records in chunks of records"""
+        data = [{0: self.source_metadata},
+                {1: self.source_metadata},
+                {2: self.source_metadata}]
+        with patch('core.management.commands.transform_source_metadata'
+                   '.store_transformed_source_metadata',
+                   return_value=None) as mock_store_transformed_source:
+            transform_source_using_key(data, self.source_target_mapping,
+                                       self.test_required_column_names,
+                                       chunk_size)
+
+            self.assertEqual(
+                mock_store_transformed_source.call_count, chunk_count)
+            self.assertEqual(
+                sum(len(call[0][0]) for call in
+                    mock_store_transformed_source.call_args_list), 3)
 
     # Test cases for validate_target_metadata
 
@@ -315,13 +558,18 @@ class CommandTests(TestSetUp):
                 record_lifecycle_status='Active').exclude(
                 source_metadata_transformation_date=None)
             meta_obj.first.return_value = target_data_dict
-            return_from_function = get_target_metadata_for_validation()
+            return_from_function = get_target_metadata_for_validation(
+                self.schema_version)
             self.assertEqual(meta_obj.first.return_value,
                              return_from_function)
 
-    def test_validate_target_using_key_more_than_one(self):
+    @data((500, 1), (1, 2))
+    @unpack
+    def test_validate_target_using_key_more_than_one(self, batch_size,
+                                                     store_count):
         """Test to Validating target data against required & recommended
-        column names for more than one row"""
+        column names for more than one row, storing results with the same
+        outcome together"""
         data = [{1: self.target_metadata}, {2: self.target_metadata}]
         test_required_column_names = {
             'CourseInstance.EndDate', 'CourseInstance.DeliveryMode',
@@ -344,10 +592,11 @@ class CommandTests(TestSetUp):
             mock_get_target_kv.filter.side_effect = [
                 mock_get_target_kv, mock_get_target_kv]
 
-            validate_target_using_key(data, test_required_column_names,
-                                      recommended_column_name)
+            validate_target_using_key(data, CompiledSchema(
+                test_required_column_names, recommended_column_name),
+                batch_size)
             self.assertEqual(
-                mock_store_target_valid_status.call_count, 2)
+                mock_store_target_valid_status.call_count, store_count)
 
     def test_validate_target_using_key_zero(self):
         """Validating target data against required & recommended column names
@@ -375,8 +624,8 @@ class CommandTests(TestSetUp):
             mock_get_target_kv.filter.side_effect = [
                 mock_get_target_kv, mock_get_target_kv]
 
-            validate_target_using_key(data, test_required_column_names,
-                                      recommended_column_name)
+            validate_target_using_key(data, CompiledSchema(
+                test_required_column_names, recommended_column_name))
 
             self.assertEqual(mock_store_target_valid_status.call_count, 0)
 
@@ -408,20 +657,10 @@ class CommandTests(TestSetUp):
                 mock_post_data_to_xis, \
                 patch('core.management.commands.load_target_metadata'
                       '.MetadataLedger.objects') as meta_obj:
-            meta_data = MetadataLedger(
-                record_lifecycle_status='Active',
-                source_metadata=self.source_metadata,
-                target_metadata=self.target_metadata,
-                target_metadata_hash=self.target_hash_value,
-                target_metadata_key_hash=self.target_key_value_hash,
-                target_metadata_key=self.target_key_value,
-                source_metadata_transformation_date=timezone.now(),
-                target_metadata_validation_status='Y',
-                source_metadata_validation_status='Y',
-                target_metadata_transmission_status='Ready')
             meta_obj.return_value = meta_obj
             meta_obj.exclude.return_value = meta_obj
-            meta_obj.values.return_value = [meta_data]
+            meta_obj.values.return_value = meta_obj
+            meta_obj.exists.return_value = True
             meta_obj.filter.side_effect = [meta_obj, meta_obj]
             get_records_to_load_into_xis()
             self.assertEqual(
@@ -437,6 +676,8 @@ class CommandTests(TestSetUp):
                       '.MetadataLedger.objects') as meta_obj:
             meta_obj.return_value = meta_obj
             meta_obj.exclude.return_value = meta_obj
+            meta_obj.values.return_value = meta_obj
+            meta_obj.exists.return_value = False
             meta_obj.filter.side_effect = [meta_obj, meta_obj]
             get_records_to_load_into_xis()
             self.assertEqual(
@@ -489,7 +730,7 @@ class CommandTests(TestSetUp):
                 patch('core.management.commands.load_target_metadata'
                       '.MetadataLedger.objects') as meta_obj, \
                 patch('requests.post') as response_obj, \
-                patch('core.management.utils.xis_client'
+                patch('core.management.utils.xia_internal'
                       '.XISConfiguration.objects') as xisCfg, \
                 patch('core.management.commands.load_target_metadata'
                       '.get_records_to_load_into_xis',
@@ -545,17 +786,10 @@ class CommandTests(TestSetUp):
                 mock_post_data_to_xis, \
                 patch('core.management.commands.load_supplemental_metadata'
                       '.SupplementalLedger.objects') as meta_obj:
-            meta_data = SupplementalLedger(
-                record_lifecycle_status='Active',
-                supplemental_metadata=self.supplemental_data,
-                supplemental_metadata_hash=self.target_hash_value,
-                supplemental_metadata_key_hash=self.target_key_value_hash,
-                supplemental_metadata_key=self.target_key_value,
-                supplemental_metadata_transmission_date=timezone.now(),
-                supplemental_metadata_transmission_status='Ready')
             meta_obj.return_value = meta_obj
             meta_obj.exclude.return_value = meta_obj
-            meta_obj.values.return_value = [meta_data]
+            meta_obj.values.return_value = meta_obj
+            meta_obj.exists.return_value = True
             meta_obj.filter.side_effect = [meta_obj, meta_obj]
             load_supplemental_metadata_to_xis()
             self.assertEqual(
@@ -571,6 +805,8 @@ class CommandTests(TestSetUp):
                       '.SupplementalLedger.objects') as meta_obj:
             meta_obj.return_value = meta_obj
             meta_obj.exclude.return_value = meta_obj
+            meta_obj.values.return_value = meta_obj
+            meta_obj.exists.return_value = False
             meta_obj.filter.side_effect = [meta_obj, meta_obj]
             load_supplemental_metadata_to_xis()
             self.assertEqual(
@@ -623,7 +859,7 @@ class CommandTests(TestSetUp):
                 patch('core.management.commands.load_supplemental_metadata'
                       '.SupplementalLedger.objects') as meta_obj, \
                 patch('requests.post') as response_obj, \
-                patch('core.management.utils.xis_client'
+                patch('core.management.utils.xia_internal'
                       '.XISConfiguration.objects') as xisCfg, \
                 patch('core.management.commands.load_supplemental_metadata'
                       '.load_supplemental_metadata_to_xis',
@@ -1,8 +1,11 @@
+from datetime import datetime, timezone
 from uuid import UUID
 
 import pandas as pd
 from django.test import TestCase
 
+from core.management.utils.xia_internal import clear_configuration_snapshot
+
 
 class TestSetUp(TestCase):
     """Class with setup and teardown for tests in XIS"""
@@ -10,6 +13,9 @@ class TestSetUp(TestCase):
     def setUp(self):
         """Function to set up necessary data for testing"""
 
+        # configuration is loaded again from each test's own data
+        clear_configuration_snapshot()
+
         # globally accessible data sets
 
         self.source_metadata = {
@@ -27,7 +33,8 @@ class TestSetUp(TestCase):
 
         self.key_value = "TestData 123_JKO"
         self.key_value_hash = "0a453b6bea6e7b1d25fb9799ef734f57"
-        self.hash_value = "f454114ba41034e14df2a8f3c14a047d"
+        self.hash_value = "987fc8ecfe330f963670e1bde577d52f"
+        self.schema_version = "5d41402abc4b2a76b9719d911017c592"
 
         self.target_metadata = {
             "Course": {
@@ -317,6 +324,13 @@ class TestSetUp(TestCase):
         self.metadata_df = pd.DataFrame.from_dict({1: self.source_metadata},
                                                   orient='index')
 
+        self.source_file_fingerprint = {
+            'source_file_name': 'jko_source_file.xlsx',
+            'source_file_size': 1024,
+            'source_file_modified': datetime(2021, 7, 26, tzinfo=timezone.utc),
+            'source_file_etag': ''
+        }
+
         return super().setUp()
 
     def tearDown(self):
@@ -1,28 +1,48 @@
+import datetime
 import hashlib
+import json
 import logging
-from unittest.mock import patch
+import os
+import tempfile
+from io import BytesIO
+from unittest.mock import MagicMock, patch
 
+import pandas as pd
+from botocore.exceptions import ClientError, EndpointConnectionError
 from ddt import data, ddt, unpack
+from django.core.files import File
 from django.test import tag
+from openpyxl import Workbook
 
 from core.management.utils.notification import send_notifications
-from core.management.utils.xia_internal import (dict_flatten,
+from core.management.utils.xia_internal import (CompiledSchema,
+                                                ValidationReport,
+                                                clear_configuration_snapshot,
+                                                compile_mapping,
+                                                compile_schema, dict_flatten,
                                                 flatten_dict_object,
                                                 flatten_list_object,
+                                                get_configuration_snapshot,
                                                 get_key_dict,
+                                                get_metadata_hash,
                                                 get_publisher_detail,
                                                 get_source_metadata_key_value,
                                                 get_target_metadata_key_value,
                                                 replace_field_on_target_schema,
-                                                update_flattened_object,
-                                                type_cast_overwritten_values)
+                                                run_in_process_pool,
+                                                type_cast_overwritten_values,
+                                                update_flattened_object)
 from core.management.utils.xis_client import (
     get_xis_metadata_api_endpoint, get_xis_supplemental_metadata_api_endpoint)
+from core.management.utils.xsr_client import (get_source_file_fingerprint,
+                                              get_source_file_format,
+                                              get_source_files,
+                                              read_source_file_in_chunks)
 from core.management.utils.xss_client import (
-    get_aws_bucket_name, get_required_fields_for_validation,
-    get_source_validation_schema, get_target_metadata_for_transformation,
-    get_target_validation_schema)
-from core.models import XIAConfiguration, XISConfiguration
+    _schema_cache, get_aws_bucket_name, get_source_validation_schema,
+    get_target_metadata_for_transformation, get_target_validation_schema,
+    read_json_data)
+from core.models import SourceFile, XIAConfiguration, XISConfiguration
 
 from .test_setup import TestSetUp
 
@@ -45,6 +65,26 @@ class UtilsTests(TestSetUp):
             return_from_function = get_publisher_detail()
             self.assertEqual(xiaConfig.publisher, return_from_function)
 
+    def test_get_configuration_snapshot(self):
+        """Test that configuration is loaded once until it is changed"""
+        xia_config = XIAConfiguration(publisher='JKO')
+        xia_config.save()
+
+        with self.assertNumQueries(2):
+            self.assertEqual(get_configuration_snapshot().publisher, 'JKO')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_publisher_detail(), 'JKO')
+
+        xia_config.publisher = 'JKO2'
+        xia_config.save()
+        self.assertEqual(get_publisher_detail(), 'JKO2')
+
+        XIAConfiguration.objects.filter(pk=xia_config.pk).update(
+            publisher='JKO3')
+        self.assertEqual(get_publisher_detail(), 'JKO2')
+        clear_configuration_snapshot()
+        self.assertEqual(get_publisher_detail(), 'JKO3')
+
     @data(('test_key', 'test_key_hash'), ('test_key1', 'test_key_hash2'))
     @unpack
     def test_get_key_dict(self, first_value, second_value):
@@ -56,6 +96,21 @@ class UtilsTests(TestSetUp):
         result = get_key_dict(first_value, second_value)
         self.assertEquals(result, expected_result)
 
+    def test_get_metadata_hash(self):
+        """Test that metadata hash does not depend on key order or value
+        formatting"""
+        reordered_metadata = dict(reversed(list(
+            self.source_metadata.items())))
+        self.assertEqual(get_metadata_hash(self.source_metadata),
+                         get_metadata_hash(reordered_metadata))
+        self.assertEqual(get_metadata_hash({'a': 1.0, 'b': float('nan')}),
+                         get_metadata_hash({'b': None, 'a': 1}))
+        self.assertEqual(
+            get_metadata_hash({'date': datetime.datetime(2021, 1, 1)}),
+            get_metadata_hash({'date': '2021-01-01T00:00:00'}))
+        self.assertNotEqual(get_metadata_hash(self.source_metadata),
+                            get_metadata_hash(self.metadata_invalid))
+
     @data(('key_field1', 'key_field2'), ('key_field11', 'key_field22'))
     @unpack
     def test_get_source_metadata_key_value(self, first_value, second_value):
@@ -335,7 +390,8 @@ class UtilsTests(TestSetUp):
         update_flattened_object(value, prefix, flatten_dict)
         self.assertTrue(flatten_dict)
 
-    @data(('int', '1234'), ('bool', 'Yes'))
+    @data(('int', '1234'), ('bool', 'Yes'),
+          ('datetime', '2021-07-26T15:21:00Z'), ('datetime', '2021-07-26'))
     @unpack
     def test_type_cast_overwritten_values(self, first_value, second_value):
         """Test the function to check type of overwritten value and convert it
@@ -345,11 +401,20 @@ class UtilsTests(TestSetUp):
         values = type_cast_overwritten_values(field_type, field_value)
         self.assertTrue(values)
 
+    def test_type_cast_overwritten_values_datetime(self):
+        """Test that datetime overwritten values are converted to
+        datetime"""
+        self.assertEqual(type_cast_overwritten_values('datetime',
+                                                      '2021-07-26'),
+                         datetime.datetime(2021, 7, 26))
+        self.assertEqual(type_cast_overwritten_values('datetime', 'never'),
+                         'never')
+
     # Test cases for XIS_CLIENT
 
     def test_get_xis_metadata_api_endpoint(self):
         """Test to retrieve xis_metadata_api_endpoint from XIS configuration"""
-        with patch('core.management.utils.xis_client'
+        with patch('core.management.utils.xia_internal'
                    '.XISConfiguration.objects') as xisCfg:
             xisConfig = XISConfiguration(
                 xis_metadata_api_endpoint=self.xis_api_endpoint_url)
@@ -361,7 +426,7 @@ class UtilsTests(TestSetUp):
     def test_get_xis_supplemental_metadata_api_endpoint(self):
         """Test to retrieve xis_supplemental_api_endpoint from XIS
         configuration"""
-        with patch('core.management.utils.xis_client'
+        with patch('core.management.utils.xia_internal'
                    '.XISConfiguration.objects') as xisCfg:
             xisConfig = XISConfiguration(
                 xis_supplemental_api_endpoint=self.supplemental_api_endpoint)
@@ -370,6 +435,131 @@ class UtilsTests(TestSetUp):
             self.assertEqual(xisConfig.xis_supplemental_api_endpoint,
                              return_from_function)
 
+    # Test cases for XSR_CLIENT
+
+    def test_read_source_file_in_chunks(self):
+        """Test streaming the source file as fixed size dataframe chunks"""
+        workbook = Workbook()
+        worksheet = workbook.active
+        worksheet.append(['LearningResourceIdentifier', 'test_name'])
+        for ind in range(5):
+            worksheet.append(['TestData ' + str(ind), None])
+        worksheet.append([None, None])
+        source_file = BytesIO()
+        workbook.save(source_file)
+
+        chunks = list(read_source_file_in_chunks(source_file, 'xlsx',
+                                                 chunk_size=2))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(list(chunks[0].columns),
+                         ['LearningResourceIdentifier', 'test_name'])
+        self.assertEqual(chunks[2]['LearningResourceIdentifier'][0],
+                         'TestData 4')
+        self.assertIsNone(chunks[2]['test_name'][0])
+
+        source_file.seek(0)
+        chunks = list(read_source_file_in_chunks(
+            source_file, 'xlsx', columns={'LearningResourceIdentifier'}))
+        self.assertEqual(list(chunks[0].columns),
+                         ['LearningResourceIdentifier'])
+
+    @data(('csv', b'LearningResourceIdentifier,test_name\n'
+                  b'TestData 0,\nTestData 1,test name\nTestData 2,\n'),
+          ('jsonl', b'{"LearningResourceIdentifier": "TestData 0"}\n\n'
+                    b'{"LearningResourceIdentifier": "TestData 1", '
+                    b'"test_name": "test name"}\n'
+                    b'{"LearningResourceIdentifier": "TestData 2"}\n'))
+    @unpack
+    def test_read_source_file_in_chunks_formats(self, source_file_format,
+                                                content):
+        """Test streaming csv and json lines source files as dataframe
+        chunks"""
+        chunks = list(read_source_file_in_chunks(
+            File(BytesIO(content)), source_file_format, chunk_size=2))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(chunks[0]['test_name'].tolist(),
+                         [None, 'test name'])
+        self.assertEqual(chunks[1]['LearningResourceIdentifier'].tolist(),
+                         ['TestData 2'])
+
+        chunks = list(read_source_file_in_chunks(
+            File(BytesIO(content)), source_file_format,
+            columns={'test_name'}))
+        self.assertEqual(list(chunks[0].columns), ['test_name'])
+
+    def test_read_source_file_in_chunks_parquet(self):
+        """Test streaming parquet source file as dataframe chunks"""
+        source_file = BytesIO()
+        pd.DataFrame({'LearningResourceIdentifier': ['TestData 0',
+                                                     'TestData 1',
+                                                     'TestData 2'],
+                      'test_name': [None, 'test name', None]}).to_parquet(
+            source_file)
+        source_file.seek(0)
+
+        chunks = list(read_source_file_in_chunks(source_file, 'parquet',
+                                                 chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(chunks[0]['test_name'].tolist(),
+                         [None, 'test name'])
+
+    def test_read_source_file_in_chunks_unsupported_format(self):
+        """Test that reading a source file in an unknown format exits"""
+        with self.assertRaises(SystemExit):
+            list(read_source_file_in_chunks(BytesIO(), 'txt'))
+
+    def test_get_source_files(self):
+        """Test retrieving source files of XIA configuration and of its
+        catalog segments"""
+        xia_config = XIAConfiguration(source_file='jko_source_file.xlsx')
+        xia_config.save()
+        SourceFile(xia_configuration=xia_config,
+                   source_file='jko_segment_file.xlsx').save()
+
+        self.assertEqual([source_file.name for source_file in
+                          get_source_files()],
+                         ['jko_source_file.xlsx', 'jko_segment_file.xlsx'])
+
+    def test_run_in_process_pool(self):
+        """Test running a function in worker processes"""
+        self.assertEqual(run_in_process_pool(pow, [(2, 3), (3, 2)], 2),
+                         [8, 9])
+
+    @data(('', 'source.XLSX', 'xlsx'), ('', 'source.ndjson', 'jsonl'),
+          ('csv', 'source.xlsx', 'csv'))
+    @unpack
+    def test_get_source_file_format(self, configured_format, file_name,
+                                    expected_format):
+        """Test retrieving the source file format from XIA configuration
+        or from the file extension"""
+        with patch('core.management.utils.xia_internal'
+                   '.XIAConfiguration.objects') as xia_cfg:
+            xia_cfg.first.return_value = XIAConfiguration(
+                source_file_format=configured_format)
+            self.assertEqual(get_source_file_format(File(None, file_name)),
+                             expected_format)
+
+    def test_get_source_file_fingerprint(self):
+        """Test creating fingerprint of the source file"""
+        source_file = MagicMock()
+        source_file.name = 'jko_source_file.xlsx'
+        source_file.size = 1024
+        source_file.storage.get_modified_time.return_value = \
+            self.source_file_fingerprint['source_file_modified']
+        source_file.file.obj.e_tag = '"etag"'
+
+        fingerprint = get_source_file_fingerprint(source_file)
+        self.assertEqual(fingerprint,
+                         dict(self.source_file_fingerprint,
+                              source_file_etag='"etag"'))
+
+        source_file.storage.get_modified_time.side_effect = \
+            NotImplementedError
+        fingerprint = get_source_file_fingerprint(source_file)
+        self.assertIsNone(fingerprint['source_file_modified'])
+
     # Test cases for XSS_CLIENT
 
     def test_get_aws_bucket_name(self):
@@ -377,9 +567,65 @@ class UtilsTests(TestSetUp):
         result_bucket = get_aws_bucket_name()
         self.assertTrue(result_bucket)
 
+    def test_read_json_data_revalidates_cached_schema(self):
+        """Test that cached schemas are revalidated with their ETag"""
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch.dict(os.environ, {'BUCKET_NAME': 'test_bucket',
+                                        'SCHEMA_CACHE_DIR': cache_dir,
+                                        'SCHEMA_LOCAL_DIR': ''}), \
+                patch.dict(_schema_cache, clear=True), \
+                patch('core.management.utils.xss_client'
+                      '.get_s3_resource') as mock_s3:
+            s3_object = mock_s3.return_value.Object.return_value
+            s3_object.get.return_value = {
+                'ETag': '"etag1"',
+                'Body': BytesIO(json.dumps(self.schema_data_dict).encode())}
+            self.assertEqual(read_json_data('schema.json'),
+                             self.schema_data_dict)
+            s3_object.get.assert_called_once_with()
+
+            s3_object.get.side_effect = ClientError(
+                {'Error': {'Code': '304', 'Message': 'Not Modified'}},
+                'GetObject')
+            self.assertEqual(read_json_data('schema.json'),
+                             self.schema_data_dict)
+            s3_object.get.assert_called_with(IfNoneMatch='"etag1"')
+
+            # schemas cached on disk outlive the process
+            _schema_cache.clear()
+            s3_object.get.side_effect = EndpointConnectionError(
+                endpoint_url='https://s3.amazonaws.com')
+            self.assertEqual(read_json_data('schema.json'),
+                             self.schema_data_dict)
+
+    def test_read_json_data_without_cached_schema(self):
+        """Test that S3 errors are raised when no schema is cached"""
+        with patch.dict(os.environ, {'SCHEMA_CACHE_DIR': '',
+                                     'SCHEMA_LOCAL_DIR': ''}), \
+                patch.dict(_schema_cache, clear=True), \
+                patch('core.management.utils.xss_client'
+                      '.get_s3_resource') as mock_s3:
+            mock_s3.return_value.Object.return_value.get.side_effect = \
+                EndpointConnectionError(
+                    endpoint_url='https://s3.amazonaws.com')
+            with self.assertRaises(EndpointConnectionError):
+                read_json_data('schema.json')
+
+    def test_read_json_data_local_directory(self):
+        """Test reading schemas from a local directory"""
+        with tempfile.TemporaryDirectory() as local_dir, \
+                patch.dict(os.environ, {'SCHEMA_LOCAL_DIR': local_dir}), \
+                patch('core.management.utils.xss_client'
+                      '.get_s3_resource') as mock_s3:
+            with open(os.path.join(local_dir, 'schema.json'), 'w') as file:
+                json.dump(self.schema_data_dict, file)
+            self.assertEqual(read_json_data('schema.json'),
+                             self.schema_data_dict)
+            self.assertEqual(mock_s3.call_count, 0)
+
     def test_get_source_validation_schema(self):
         """Test to retrieve source_metadata_schema from XIA configuration"""
-        with patch('core.management.utils.xss_client'
+        with patch('core.management.utils.xia_internal'
                    '.XIAConfiguration.objects') as xdsCfg, \
                 patch('core.management.utils.xss_client'
                       '.read_json_data') as read_obj:
@@ -392,18 +638,90 @@ class UtilsTests(TestSetUp):
             self.assertEqual(read_obj.return_value,
                              return_from_function)
 
-    def test_get_required_fields_for_validation(self):
-        """Test for Creating list of fields which are Required """
-
-        required_column_name, recommended_column_name = \
-            get_required_fields_for_validation(self.schema_data_dict)
-
-        self.assertTrue(required_column_name)
-        self.assertTrue(recommended_column_name)
+    def test_compile_schema(self):
+        """Test compiling schema once per schema version"""
+        compiled_schema = compile_schema(self.schema_data_dict)
+
+        self.assertIs(compile_schema(dict(self.schema_data_dict)),
+                      compiled_schema)
+        self.assertTrue(compiled_schema.is_required('SOURCESYSTEM'))
+        self.assertFalse(compiled_schema.is_required('test_id'))
+        self.assertTrue(compiled_schema.is_recommended('Test_current'))
+        self.assertIn('test_id', compiled_schema.fields)
+        self.assertTrue(compiled_schema.required_fields)
+        self.assertTrue(compiled_schema.recommended_fields)
+        self.assertIsNot(compile_schema({'SOURCESYSTEM': 'Required'}),
+                         compiled_schema)
+
+    def test_compiled_schema_accessors(self):
+        """Test prefix index of compiled schema"""
+        compiled_schema = CompiledSchema(['a.b', 'a.c', 'd'], ['a.e'])
+
+        self.assertEqual(compiled_schema.get_required_fields_with_prefix('a'),
+                         ('a.b', 'a.c'))
+        self.assertEqual(compiled_schema.prefix_index, {'a': ('a.b', 'a.c')})
+        self.assertEqual(dict_flatten({'a': [{'b': 'value1'},
+                                             {'b': 'value2', 'c': 'x'}]},
+                                      compiled_schema),
+                         {'a.b': 'value2', 'a.c': 'x'})
+
+    def test_compile_mapping(self):
+        """Test compiling target mapping schema once per mapping version
+        into instructions applied to source metadata"""
+        target_mapping_dict = {'Course': {'CourseCode': 'code',
+                                          'CourseTitle': None},
+                               'Technical': {'Duration': 'length',
+                                             'CourseCode': 'literal'},
+                               'Empty': {}}
+        compiled_mapping = compile_mapping(target_mapping_dict)
+
+        self.assertIs(compile_mapping(dict(target_mapping_dict)),
+                      compiled_mapping)
+        self.assertEqual(compiled_mapping.target_sections,
+                         ('Course', 'Technical'))
+        self.assertEqual(compiled_mapping.source_paths,
+                         {'code', 'length', 'literal'})
+        target_metadata = compiled_mapping.apply(
+            {'code': 'TestData 123', 'length': 1 / 3})
+        self.assertEqual(target_metadata,
+                         {'Course': {'CourseCode': 'TestData 123'},
+                          'Technical': {'CourseCode': 'literal',
+                                        'Duration': 0.3333333333}})
+        self.assertEqual(list(target_metadata['Technical']),
+                         ['CourseCode', 'Duration'])
+
+    def test_validation_report(self):
+        """Test counting missing fields per field and per record in
+        validation report and storing its summary"""
+        report = ValidationReport('source', 'version1', sample_size=1)
+        report.add_record('key1', ['a', 'b'], ['c'])
+        report.add_record('key2', [], ['c'])
+        report.add_record('key3', [], [])
+        other_report = ValidationReport('source', 'version1')
+        other_report.add_record('key4', ['a'], [])
+        report.merge(other_report)
+
+        self.assertEqual(report.record_count, 4)
+        self.assertEqual(report.invalid_record_count, 2)
+        self.assertEqual(report.incomplete_record_count, 1)
+        self.assertEqual(report.missing_required_fields, {'a': 2, 'b': 1})
+        self.assertEqual(report.examples, [{'record': 'key1',
+                                            'missing_required': ['a', 'b'],
+                                            'missing_recommended': ['c']}])
+        with patch('core.management.utils.xia_internal'
+                   '.MetadataValidationReport.objects') as report_obj:
+            report.save()
+            report_obj.create.assert_called_once_with(
+                validation_stage='source', schema_version='version1',
+                record_count=4, invalid_record_count=2,
+                incomplete_record_count=1,
+                missing_required_fields={'a': 2, 'b': 1},
+                missing_recommended_fields={'c': 2},
+                examples=report.examples)
 
     def test_get_target_validation_schema(self):
         """Test to retrieve target_metadata_schema from XIA configuration"""
-        with patch('core.management.utils.xss_client'
+        with patch('core.management.utils.xia_internal'
                    '.XIAConfiguration.objects') as xiaconfigobj, \
                 patch('core.management.utils.xss_client'
                       '.read_json_data') as read_obj:
@@ -418,7 +736,7 @@ class UtilsTests(TestSetUp):
 
     def test_get_target_metadata_for_transformation(self):
         """Test to retrieve target metadata schema from XIA configuration """
-        with patch('core.management.utils.xss_client'
+        with patch('core.management.utils.xia_internal'
                    '.XIAConfiguration.objects') as xia_config_obj, \
                 patch('core.management.utils.xss_client'
                       '.read_json_data') as read_obj: